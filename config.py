@@ -1,19 +1,62 @@
 # coding: utf-8  
 
+# Boards to watch
+# Every board can override 'include' and 'exclude' keywords, update 'interval'
+# and the number of thread download 'workers', defaults are set below
+BOARDS = {
+    'b': {},
+}
+#BOARDS = {
+#    'b': {},
+#    'a': {'include': r'(?i)webm', 'interval': 120, 'workers': 2},
+#}
+
 # Path to directory with WebM files
 RANDOM_PATH = 'webm'
 
 # Should we save all played to the end files to that directory?
 SAVE_FILES = True
 
+# Maximum size of that directory in bytes, least recently played files are removed first.
+# Pinned files (p key) are never removed. None means no limit
+CACHE_MAX_SIZE = 10 * 1024 ** 3
+
+# Random files from that directory are played when the queue is empty,
+# every file once before any repeats. Optionally prefer some of them:
+# 'recent' - recently saved files, 'plays' - less played files (needs STATE_FILE), None - no preference
+SHUFFLE_WEIGHT = None
+
 # Keywords in an OP's post to search for
+# Either a regular expression or a list of them
 INCLUDE_KEYWORDS = r'(?i)(([WEBM]|[ЦУИЬ])|([ВШ][ЕБМ]))'
 #INCLUDE_KEYWORDS = None
 
-# Keywords to exclude
+# Keywords to exclude, same format as INCLUDE_KEYWORDS
 #EXCLUDE_KEYWORDS = r'(?i)((анимублядский)|(порн))'
+#EXCLUDE_KEYWORDS = [r'(?i)анимублядский', r'(?i)порн']
 EXCLUDE_KEYWORDS = None
 
+# Poll only posts after the last seen one instead of downloading whole threads
+# Falls back to full thread downloads if the board doesn't support it
+INCREMENTAL_UPDATES = True
+
+# Number of threads downloaded in parallel
+THREAD_FETCH_WORKERS = 8
+
+# The board is updated in the background when there are less than
+# QUEUE_LOW_WATER videos in the queue, at most every UPDATE_INTERVAL seconds
+QUEUE_LOW_WATER = 5
+UPDATE_INTERVAL = 30
+
+# SQLite database to keep found threads, seen files and playback history
+# between restarts. Set to None to keep everything in memory
+STATE_FILE = 'state.sqlite'
+
+# Play order of the queued videos:
+# 'fifo' - in order they were found, 'newest' - most recently found first,
+# 'smallest' - smallest files first when bandwidth is low, 'roundrobin' - one video of every thread in turn
+SCHEDULER_POLICY = 'fifo'
+
 # Cloudflare "cf_clearance" cookie value
 # Currently supported only by gstreamer backend
 CF_COOKIE = '861a0566de1421f863f81936700d70e6f9d15356-1444513397-604800'
@@ -21,6 +64,30 @@ CF_COOKIE = '861a0566de1421f863f81936700d70e6f9d15356-1444513397-604800'
 # Your User-Agent for that cookie
 CF_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:41.0) Gecko/20100101 Firefox/41.0'
 
+# Maximum number of kept-alive connections to every host
+HTTP_POOL_SIZE = 8
+
+# Requests per second and burst size allowed to every host for board and thread updates.
+# Throttled requests (429, 503, Cloudflare challenge) are retried with backoff.
+# Video downloads are not limited
+RATE_LIMIT = 2
+RATE_LIMIT_BURST = 5
+# Per-host overrides: {'2ch.hk': (rate, burst)}
+RATE_LIMIT_HOSTS = {}
+
+# Download videos through a local proxy which reuses the updater's
+# connections instead of opening a new one for every video
+USE_MEDIA_PROXY = True
+
+# Download up to PREFETCH_DEPTH next videos in the background while the current
+# one plays, fewer on fast links. Set to 0 to stream every video when it starts
+PREFETCH_DEPTH = 3
+# Downloads go to a 'prefetch' subdirectory of it
+PREFETCH_PATH = 'webm/.cache'
+# Maximum size in bytes of unfinished downloads kept there to be resumed later,
+# oldest ones are removed first. None means no limit
+PREFETCH_STAGING_SIZE = 1024 ** 3
+
 # Backend to use
 # 'gstreamer' or 'vlc'
 BACKEND = 'gstreamer'
@@ -35,10 +102,17 @@ AUDIO_COMPRESSOR = False
 GSTREAMER_VIDEO_SINK = 'autovideosink'
 GSTREAMER_AUDIO_SINK = 'autoaudiosink'
 
+# Video decoder threads, None to choose from the CPU count and the video resolution
+GSTREAMER_DECODER_THREADS = None
+
 # Use gstreamer buffering
 # Generally works fine but sometimes could stale a stream
 GSTREAMER_BUFFERING = True
 
+# Gapless switching between videos: the next one is prerolled while the current one plays
+# Streamed files are saved only with prefetching on, additional pipeline is not supported
+GSTREAMER_GAPLESS = False
+
 # Additional GStreamer pipeline. Can be used to stream video to the remote server
 # In order to use it, you should create two queues with names "vq" and "aq"
 #GSTREAMER_ADDITIONAL_PIPELINE = 'queue name=vq ! fakesink queue name=aq ! fakesink'
@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
 # coding: utf-8
 import updater.updater
+import updater.worker
+import updater.matcher
+import updater.state
+import updater.httpclient
+import updater.ratelimit
+import updater.coordinator
+from player.proxy import MediaProxy
+from player.prefetch import Prefetcher
+from player.cache import DiskCache
+from player.library import Library, recency_weight
 import signal
 import logging
 import config
+import os.path
 import re
+import urllib.parse
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -12,21 +24,24 @@ logger = logging.getLogger('main')
 
 if config.BACKEND == 'gstreamer':
     import player.gstreamer
-    player = player.gstreamer.Player(
+    player = (player.gstreamer.GaplessPlayer if config.GSTREAMER_GAPLESS else player.gstreamer.Player)(
         config.RANDOM_PATH if config.SAVE_FILES else None,
         config.AUDIO_COMPRESSOR,
         config.GSTREAMER_VIDEO_SINK,
         config.GSTREAMER_AUDIO_SINK,
         config.GSTREAMER_ADDITIONAL_PIPELINE,
-        config.GSTREAMER_BUFFERING
+        config.GSTREAMER_BUFFERING,
+        config.SCHEDULER_POLICY
     )
+    player.decoder_threads = config.GSTREAMER_DECODER_THREADS
 elif config.BACKEND == 'vlc':
     import player.vlc
     player = player.vlc.Player(
         config.RANDOM_PATH if config.SAVE_FILES else None,
         config.AUDIO_COMPRESSOR,
         config.VLC_VIDEO_SINK,
-        config.VLC_AUDIO_SINK
+        config.VLC_AUDIO_SINK,
+        config.SCHEDULER_POLICY
     )
 else:
     logger.error('No working backend set!')
@@ -37,28 +52,68 @@ player.set_random_directory(config.RANDOM_PATH)
 player.cookie = config.CF_COOKIE
 player.user_agent = config.CF_USER_AGENT
 
-board = updater.updater.Board()
-board.req.cookies.set('cf_clearance', config.CF_COOKIE)
-board.req.headers['User-Agent'] = config.CF_USER_AGENT
+state = updater.state.State(config.STATE_FILE) if config.STATE_FILE else None
+if state:
+    player.register_on_play_callback(state.add_history)
 
-try:
-    compiled_include_keywords = re.compile(config.INCLUDE_KEYWORDS)
-    compiled_exclude_keywords = re.compile(config.EXCLUDE_KEYWORDS) if config.EXCLUDE_KEYWORDS else ''
-except (ConfigurationError, AttributeError, TypeError, NameError):
-    logger.fatal("You should set both INCLUDE_KEYWORDS and EXCLUDE_KEYWORDS in the configuration file!")
-    quit(1)
+if config.SHUFFLE_WEIGHT == 'recent':
+    weight = recency_weight
+elif config.SHUFFLE_WEIGHT == 'plays' and state:
+    weight = lambda path: 1.0 / (1 + state.play_count(os.path.basename(path)))
+else:
+    weight = None
+player.library = Library(config.RANDOM_PATH, weight=weight)
+player.cache = DiskCache(config.RANDOM_PATH, config.CACHE_MAX_SIZE if config.SAVE_FILES else None, player.library)
+
+# One connection pool for the board updates and the media downloads
+limiter = updater.ratelimit.RateLimiter(config.RATE_LIMIT, config.RATE_LIMIT_BURST, config.RATE_LIMIT_HOSTS)
+client = updater.httpclient.Client(config.HTTP_POOL_SIZE, limiter)
+board_host = urllib.parse.urlsplit(updater.updater.BASEURL).hostname
+client.cookies.set('cf_clearance', config.CF_COOKIE, domain=board_host)
+client.headers['User-Agent'] = config.CF_USER_AGENT
+
+if config.PREFETCH_DEPTH:
+    player.prefetcher = Prefetcher(client, player.videoqueue, config.PREFETCH_PATH,
+                                   config.RANDOM_PATH if config.SAVE_FILES else None,
+                                   1, config.PREFETCH_DEPTH, staging_max_size=config.PREFETCH_STAGING_SIZE,
+                                   throughput=player.throughput)
 
-def on_empty_queue():
-    logger.info('Queue is empty, updating')
-    board.update()
-    board.find_threads(compiled_include_keywords, compiled_exclude_keywords)
-    board.parse_threads()
-    for video in board.get_new_videos_list():
-        logger.debug('Got video {}'.format(video))
-        player.videoqueue.put(video)
+if config.USE_MEDIA_PROXY:
+    player.proxy = MediaProxy(client, [board_host], player.prefetcher)
+    player.proxy.start()
+
+boards = list()
+for board_id, settings in config.BOARDS.items():
+    try:
+        matcher = updater.matcher.Matcher(settings.get('include', config.INCLUDE_KEYWORDS),
+                                          settings.get('exclude', config.EXCLUDE_KEYWORDS))
+    except re.error as e:
+        logger.fatal('Invalid keyword pattern for /{}/: {}'.format(board_id, e))
+        quit(1)
+    except (AttributeError, TypeError, NameError):
+        logger.fatal("You should set both INCLUDE_KEYWORDS and EXCLUDE_KEYWORDS in the configuration file!")
+        quit(1)
+
+    boards.append(updater.updater.Board(
+        board_id,
+        config.INCREMENTAL_UPDATES,
+        settings.get('workers', config.THREAD_FETCH_WORKERS),
+        config.RANDOM_PATH if config.SAVE_FILES else None,
+        matcher,
+        state,
+        client,
+        settings.get('interval', config.UPDATE_INTERVAL)
+    ))
+coordinator = updater.coordinator.Coordinator(boards)
 
-player.register_on_video_queue_empty_callback(on_empty_queue)
-on_empty_queue()
+# Boards are updated in the background, the player only wakes the worker up
+worker = updater.worker.Worker(coordinator.update, player.videoqueue, config.QUEUE_LOW_WATER,
+                               min(board.interval for board in boards))
+player.register_on_video_queue_empty_callback(worker.wake)
+worker.fill_queue()
 
 if __name__ == '__main__':
+    worker.start()
+    if player.prefetcher:
+        player.prefetcher.start()
     player.run()
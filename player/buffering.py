@@ -0,0 +1,96 @@
+# coding: utf-8
+import logging
+import math
+import threading
+
+
+class Throughput(object):
+    """
+    Download rate in bytes per second, exponentially weighted.
+
+    One estimate is shared by the player's buffering, the prefetcher
+    and the scheduler, which gets every update.
+    """
+    def __init__(self, scheduler=None, weight=0.3):
+        self.scheduler = scheduler
+        self.weight = weight
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def measure(self, rate):
+        if rate <= 0:
+            return
+        with self.lock:
+            self.rate = rate if self.rate is None else self.rate * (1 - self.weight) + rate * self.weight
+            estimate = self.rate
+        if self.scheduler:
+            self.scheduler.set_bandwidth(estimate)
+
+
+class BufferingController(object):
+    """
+    Picks buffering thresholds and queue limits for every streamed video.
+
+    Download rate comes from the shared Throughput estimate, the
+    video's bitrate from its size and duration. A video which downloads
+    slower than it plays would stall, so enough of it is buffered before
+    the start to play to the end without stalling, up to max_time seconds.
+    A fast link starts playback early with a short queue.
+    Without a rate or a bitrate the old 20/80 thresholds are used.
+
+    plan() sets:
+      queue_time     queue limit in seconds, None for the queue default
+      queue_bytes    queue limit in bytes, None for the queue default
+      low_percent    pause when the buffer drops below it
+      start_percent  start or resume when the buffer reaches it
+    """
+    def __init__(self, throughput, min_time=2, max_time=30, headroom=1.25):
+        self.logger = logging.getLogger('buffering')
+        self.throughput = throughput
+        self.min_time = min_time
+        self.max_time = max_time
+        self.headroom = headroom
+        self.reset()
+
+    def reset(self):
+        self.queue_time = None
+        self.queue_bytes = None
+        self.low_percent = 20
+        self.start_percent = 80
+
+    def plan(self, video, streaming=True):
+        self.reset()
+        size = getattr(video, 'size', None)
+        duration = getattr(video, 'duration', None)
+        if not streaming:
+            # Local file, nothing to wait for
+            self.queue_time = self.min_time
+            self.low_percent = 1
+            self.start_percent = 1
+            return
+        rate = self.throughput.rate
+        if not rate or not size or not duration:
+            return
+
+        bitrate = size * 1024 / duration
+        ratio = bitrate / rate
+        # Seconds of the video to have before starting to play it through without a stall
+        needed = duration * (1 - 1 / ratio) * self.headroom if ratio > 1 else 0
+        self.queue_time = max(self.min_time, min(self.max_time, math.ceil(needed + self.min_time)))
+        self.queue_bytes = math.ceil(bitrate * self.queue_time * self.headroom)
+        if ratio > 1:
+            # Will stall otherwise: fill the queue, resume only when it's full again
+            self.low_percent = 10
+            self.start_percent = 100
+        else:
+            # The faster the link, the earlier playback starts
+            self.low_percent = 5
+            self.start_percent = max(10, min(80, math.ceil(100 * ratio)))
+        self.logger.debug('Bitrate {:.0f} KiB/s at {:.0f} KiB/s: buffering {} s, starting at {}%'.format(
+            bitrate / 1024, rate / 1024, self.queue_time, self.start_percent))
+
+    def stalled(self):
+        """
+        Called when playback paused for buffering: wait for a full queue before resuming.
+        """
+        self.start_percent = 100
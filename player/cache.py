@@ -0,0 +1,139 @@
+# coding: utf-8
+import collections
+import logging
+import os
+import os.path
+import threading
+
+
+class DiskCache(object):
+    """
+    Size-capped cache of the saved WebM files.
+
+    Files are kept in least recently played order and the oldest unpinned
+    ones are removed once the directory grows over max_bytes.
+    The index is a journal in INDEX_NAME inside the directory:
+      + size name   file added or played
+      - name        file removed
+      * name        file pinned
+      ! name        file unpinned
+    It is compacted on load, the directory is walked only if there is no index.
+    Added and evicted files are reported to the library if it's set.
+    """
+    INDEX_NAME = '.cacheindex'
+
+    def __init__(self, directory, max_bytes=None, library=None):
+        self.logger = logging.getLogger('cache')
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, self.INDEX_NAME)
+        self.max_bytes = max_bytes
+        self.library = library
+        self.entries = collections.OrderedDict()
+        self.pinned = set()
+        self.size = 0
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self.load()
+        else:
+            self.scan()
+        self.compact()
+
+    def load(self):
+        with open(self.path) as index:
+            for line in index:
+                op, _, args = line.rstrip('\n').partition(' ')
+                if op == '+':
+                    size, _, name = args.partition(' ')
+                    self.entries.pop(name, None)
+                    self.entries[name] = int(size)
+                elif op == '-':
+                    self.entries.pop(args, None)
+                elif op == '*':
+                    self.pinned.add(args)
+                elif op == '!':
+                    self.pinned.discard(args)
+        self.size = sum(self.entries.values())
+
+    def scan(self):
+        self.logger.info('Building cache index of {}'.format(self.directory))
+        files = [entry for entry in os.scandir(self.directory)
+                 if entry.name.endswith('.webm') and entry.is_file()]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_atime):
+            self.entries[entry.name] = entry.stat().st_size
+        self.size = sum(self.entries.values())
+
+    def compact(self):
+        partial = self.path + '.tmp'
+        with open(partial, 'w') as index:
+            for name, size in self.entries.items():
+                index.write('+ {} {}\n'.format(size, name))
+            for name in self.pinned:
+                index.write('* {}\n'.format(name))
+        os.replace(partial, self.path)
+
+    def log(self, *line):
+        try:
+            with open(self.path, 'a') as index:
+                index.write(' '.join(str(arg) for arg in line) + '\n')
+        except OSError as e:
+            self.logger.error('Cannot write cache index: {}'.format(e))
+
+    def name(self, path):
+        """
+        Return the file name if path is inside the cache directory or None.
+        """
+        if os.path.dirname(os.path.abspath(path)) != self.directory:
+            return None
+        return os.path.basename(path)
+
+    def add(self, path):
+        """
+        Add a saved file or mark a cached one as just played,
+        then evict old files if the cache is too big.
+        """
+        name = self.name(path)
+        if not name:
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.log('+', size, name)
+            if self.library:
+                self.library.add(name)
+            self.evict()
+
+    def evict(self):
+        if not self.max_bytes or self.size <= self.max_bytes:
+            return
+        victims = list()
+        size = self.size
+        for name, file_size in self.entries.items():
+            if size <= self.max_bytes:
+                break
+            if name not in self.pinned:
+                victims.append(name)
+                size -= file_size
+        for name in victims:
+            self.logger.info('Evicting {}'.format(name))
+            self.size -= self.entries.pop(name)
+            self.log('-', name)
+            if self.library:
+                self.library.remove(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError as e:
+                self.logger.error('Cannot remove {}: {}'.format(name, e))
+
+    def pin(self, name):
+        with self.lock:
+            if name in self.pinned:
+                self.pinned.discard(name)
+                self.log('!', name)
+                return False
+            self.pinned.add(name)
+            self.log('*', name)
+            return True
@@ -15,6 +15,8 @@ import logging
 import glob
 import sys
 import ctypes
+from player.scheduler import Scheduler
+from player.buffering import BufferingController, Throughput
 
 GObject.threads_init()
 Gst.init(None)
@@ -29,7 +31,7 @@ class Player(object):
         ctypes.cdll.LoadLibrary('libX11.so').XInitThreads()
 
     def __init__(self, file_save_dir=False, use_compressor=False, video_sink='autovideosink',
-                 audio_sink='autoaudiosink', add_sink=None, buffering=True):
+                 audio_sink='autoaudiosink', add_sink=None, buffering=True, scheduler_policy='fifo'):
         self.logger = logging.getLogger('video')
         self.window = Gtk.Window()
         self.window.connect('destroy', self.quit)
@@ -41,7 +43,7 @@ class Player(object):
         self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
 
         # Create GStreamer pipeline
-        self.pipeline = Gst.Pipeline()
+        self.pipeline = self.create_pipeline()
 
         # Create bus to get events from GStreamer pipeline
         self.bus = self.pipeline.get_bus()
@@ -50,12 +52,15 @@ class Player(object):
         self.bus.connect('message::error', self.on_error)
         self.bus.connect('message::buffering', self.on_buffering)
 
+        # Decoders are configured as decodebin creates them
+        self.pipeline.connect('deep-element-added', self.on_element_added)
+
         # This is needed to make the video output in our DrawingArea:
         self.bus.enable_sync_message_emission()
         self.bus.connect('sync-message::element', self.on_sync_message)
 
         # Add video queue
-        self.videoqueue = queue.Queue()
+        self.videoqueue = Scheduler(scheduler_policy)
         self.randomdir = None
         self.file_save_dir = file_save_dir
         self.use_compressor = use_compressor
@@ -65,13 +70,29 @@ class Player(object):
         self.window_is_fullscreen = False
         self.is_paused = True
         self.uri = None
+        self.video = None
         self.empty_queue_callback = None
+        self.play_callback = None
+        self.proxy = None
+        self.prefetcher = None
+        self.cache = None
+        self.library = None
         self.user_agent = None
         self.cookie = None
         self.buffering = buffering
+        self.throughput = Throughput(self.videoqueue)
+        self.buffering_controller = BufferingController(self.throughput)
+        self.decoder_threads = None
+        # Current video decoder and the video it was configured for
+        self.decoder = None
+        self.decoder_video = None
+        self.saving = False
 
         self.build_pipeline()
 
+    def create_pipeline(self):
+        return Gst.Pipeline()
+
     def build_pipeline(self):
         # Create GStreamer elements
         self.videobin = Gst.parse_bin_from_description('queue max-size-buffers=0 max-size-bytes=0 max-size-time=1000000000 ! '
@@ -89,8 +110,21 @@ class Player(object):
         self.videotee = Gst.ElementFactory.make('tee', 'videotee')
         if self.add_sink:
             self.add_pipeline = Gst.parse_bin_from_description(self.add_sink, False)
+            self.add_video_queue = self.add_pipeline.get_by_name('vq')
+            self.add_audio_queue = self.add_pipeline.get_by_name('aq')
             self.pipeline.add(self.add_pipeline)
 
+        # Sources and tee branches are built once and relinked for every video
+        self.httpsrc = Gst.ElementFactory.make('souphttpsrc', 'httpsrc')
+        self.filesrc = Gst.ElementFactory.make('filesrc', 'filesrc')
+        self.filesink = Gst.ElementFactory.make('filesink', 'filesink')
+        self.filesink.set_property('async', False)
+        self.save_branch, self.save_queue = self.make_branch(True)
+        self.play_branch, self.play_queue = self.make_branch(False)
+        self.source = self.filesrc
+        self.branch = self.play_branch
+        self.decodequeue = self.play_queue
+
         # Add everything to the pipeline
         self.pipeline.add(self.decodebin)
         self.pipeline.add(self.audioconvert_tee)
@@ -104,52 +138,76 @@ class Player(object):
         self.decodebin.connect('pad-added', self.on_pad_added)
         self.decodebin.connect('no-more-pads', self.on_no_more_pads)
 
+    def make_branch(self, save):
+        # tee ! queue2 to the decoder, plus a queue to the filesink when saving
+        description = 'tee name=tee ! queue2 name=decodequeue use-buffering=true'
+        if save:
+            description += ' tee. ! queue name=filequeue'
+        branch = Gst.parse_bin_from_description(description, False)
+        decodequeue = branch.get_by_name('decodequeue')
+        branch.add_pad(Gst.GhostPad.new('sink', branch.get_by_name('tee').get_static_pad('sink')))
+        branch.add_pad(Gst.GhostPad.new('decode', decodequeue.get_static_pad('src')))
+        if save:
+            branch.add_pad(Gst.GhostPad.new('file', branch.get_by_name('filequeue').get_static_pad('src')))
+        return branch, decodequeue
+
     def reinit_pipeline(self, uri):
-        if self.pipeline.get_by_name('tee'):
-            self.pipeline.remove(self.tee_queue)
-        if self.pipeline.get_by_name('uri'):
-            self.pipeline.remove(self.source)
-        if self.pipeline.get_by_name('filesink'):
-            self.pipeline.remove(self.filesink)
+        # Pooled elements are swapped in and out, the pipeline is in NULL state here.
+        # Removing an element from the pipeline unlinks its pads.
+        for element in (self.source, self.branch, self.filesink):
+            if element.get_parent():
+                self.pipeline.remove(element)
 
+        save_path = os.path.join(self.file_save_dir, os.path.basename(uri)) if self.file_save_dir else None
         if 'http://' in uri or 'https://' in uri:
-            self.source = Gst.ElementFactory.make('souphttpsrc' ,'uri')
+            self.source = self.httpsrc
             self.source.set_property('user-agent', self.user_agent) if self.user_agent else None
             self.source.set_property('cookies', ['cf_clearance=' + self.cookie]) if self.cookie else None
-
-            if self.file_save_dir and not os.path.isfile(self.file_save_dir + '/' + os.path.basename(uri)):
-                self.tee_queue = Gst.parse_bin_from_description('tee name=tee \
-                                tee. ! queue name=filequeue \
-                                tee. ! queue2 name=decodequeue use-buffering=true', False)
-                self.filesink = Gst.ElementFactory.make('filesink' ,'filesink')
-                self.filesink.set_property('location', self.file_save_dir + '/' + os.path.basename(uri))
-                self.filesink.set_property('async', False)
-            else:
-                self.tee_queue = Gst.parse_bin_from_description('tee name=tee ! queue2 name=decodequeue use-buffering=true', False)
-                self.filesink = None
+            self.saving = bool(save_path) and not os.path.isfile(save_path)
         else:
-            self.tee_queue = Gst.parse_bin_from_description('tee name=tee ! queue2 name=decodequeue use-buffering=true', False)
-            self.source = Gst.ElementFactory.make('filesrc' ,'uri')
-            self.filesink = None
+            self.source = self.filesrc
+            self.saving = False
+        self.branch = self.save_branch if self.saving else self.play_branch
+        self.decodequeue = self.save_queue if self.saving else self.play_queue
 
-        self.pipeline.add(self.tee_queue)
-        self.pipeline.get_by_name('decodequeue').link(self.decodebin)
         self.pipeline.add(self.source)
-        if self.filesink:
+        self.pipeline.add(self.branch)
+        self.source.link(self.branch)
+        self.branch.link_pads('decode', self.decodebin, None)
+        if self.saving:
+            self.filesink.set_property('location', save_path)
             self.pipeline.add(self.filesink)
-            self.pipeline.get_by_name('filequeue').link(self.filesink)
-        self.source.link(self.pipeline.get_by_name('tee'))
-        self.source.set_property('location', uri)
+            self.branch.link_pads('file', self.filesink, None)
+        if self.proxy and ('http://' in uri or 'https://' in uri):
+            self.source.set_property('location', self.proxy.url(uri))
+        else:
+            self.source.set_property('location', uri)
 
         self.has_audio = False
         self.has_video = False
 
-    def seturi(self, uri):
-        if not uri:
+    def set_buffering(self, video, uri):
+        controller = self.buffering_controller
+        controller.plan(video, 'http://' in uri or 'https://' in uri)
+        # The thresholds are checked in on_buffering
+        for name, value in (('max-size-time', controller.queue_time and int(controller.queue_time * Gst.SECOND)),
+                            ('max-size-bytes', controller.queue_bytes)):
+            self.decodequeue.set_property(name, value or self.decodequeue.find_property(name).default_value)
+
+    def seturi(self, video):
+        # Queue holds updater.updater.Video records or plain paths
+        if not video:
             return
+        if self.prefetcher:
+            self.prefetcher.acquire(video)
+        uri = str(video)
         self.reinit_pipeline(uri)
+        self.set_buffering(video, uri)
+        self.video = video
         self.uri = uri
         self.update_titlebar()
+        if self.play_callback:
+            self.play_callback(uri)
 
     def run(self):
         self.window.show_all()
@@ -186,16 +244,21 @@ class Player(object):
         self.is_paused = True
 
     def stop(self, should_delete=False):
-        location = None
-        if should_delete:
-            try:
-                location = self.filesink.get_property('location')
-            except:
-                pass
+        location = self.filesink.get_property('location') if self.saving else None
 
         self.pipeline.set_state(Gst.State.NULL)
-        if location:
-            os.remove(location)
+        if location and should_delete:
+            if self.prefetcher and getattr(self.video, 'url', None):
+                # Resumed later instead of downloading it again
+                self.prefetcher.stage(self.video, location)
+            else:
+                os.remove(location)
+            if self.library:
+                self.library.sync()
+        if self.prefetcher and self.video:
+            self.prefetcher.release(self.video, not should_delete)
+        if self.cache and self.video and not should_delete:
+            self.cache.add(location or str(self.video))
         self.is_paused = True
 
     def quit(self, window = None):
@@ -214,7 +277,15 @@ class Player(object):
     def register_on_video_queue_empty_callback(self, callback):
         self.empty_queue_callback = callback
 
+    def register_on_play_callback(self, callback):
+        self.play_callback = callback
+
     def get_random(self):
+        if self.library:
+            video = self.library.random()
+            if not video:
+                self.logger.error('Directory with random files is empty!')
+            return video
         if self.randomdir is None:
             raise NoDirectoryException('Directory path is not set!')
         try:
@@ -242,6 +313,12 @@ class Player(object):
             self.window.get_window().set_cursor(self.cursor_left)
             self.window_is_fullscreen = False
 
+    def toggle_pin(self):
+        if not self.cache or not self.uri:
+            return
+        name = os.path.basename(self.uri)
+        self.logger.info('{} {}'.format('Pinned' if self.cache.pin(name) else 'Unpinned', name))
+
     def toggle_play(self):
         if not self.is_paused:
             self.pause()
@@ -270,7 +347,7 @@ class Player(object):
         return not self.is_paused
 
     def link_video(self, element=None, pad=None):
-        if not self.pipeline.get_by_name(self.videobin.get_name()):
+        if not self.videobin.get_parent():
             self.pipeline.add(self.videobin)
         if element and pad:
             # If we have an element with a pad, we link exact pad to the
@@ -280,20 +357,66 @@ class Player(object):
             self.decodebin.link(self.videoconvert_tee)
         self.videotee.link(self.videobin)
         if self.add_sink:
-            self.videotee.link(self.pipeline.get_by_name('vq'))
+            self.videotee.link(self.add_video_queue)
         self.videobin.sync_state_with_parent()
 
+    def get_decoder_threads(self, video):
+        if self.decoder_threads:
+            return self.decoder_threads
+        cpus = os.cpu_count() or 1
+        # Leave a core for audio and the UI
+        available = max(1, cpus - 1)
+        width = getattr(video, 'width', None)
+        height = getattr(video, 'height', None)
+        if not width or not height:
+            return max(1, min(available, cpus // 2))
+        # About one thread per 640x360 of picture, up to the available cores
+        return max(1, min(available, -(-width * height // (640 * 360))))
+
+    def on_element_added(self, pipeline, sub_bin, element):
+        # Called from a streaming thread
+        factory = element.get_factory()
+        if not factory or 'Decoder/Video' not in (factory.get_metadata('klass') or ''):
+            return
+        self.decoder = element
+        self.configure_decoder(getattr(self, 'next_video', None) or self.video)
+
+    def configure_decoder(self, video):
+        element = self.decoder
+        self.decoder_video = video
+        threads = self.get_decoder_threads(video)
+        # vp8dec and vp9dec have threads, avdec_* max-threads
+        prop = element.find_property('threads') or element.find_property('max-threads')
+        if prop:
+            threads = min(threads, prop.maximum)
+            element.set_property(prop.name, threads)
+            if element.find_property('thread-type'):
+                Gst.util_set_object_arg(element, 'thread-type', 'frame+slice')
+        else:
+            threads = None
+        self.logger.info('Decoding {} with {}{}'.format(
+            os.path.basename(str(video)), element.get_factory().get_name(),
+            ' in {} threads'.format(threads) if threads else ''))
+
     def on_sync_message(self, bus, msg):
         if msg.get_structure().get_name() == 'prepare-window-handle':
             self.logger.debug('prepare-window-handle')
             msg.src.set_window_handle(self.xid)
 
+    def is_streaming(self):
+        return self.source is self.httpsrc
+
     def on_buffering(self, bus, msg):
         buf = msg.parse_buffering()
+        avg_in = msg.parse_buffering_stats()[1]
+        if avg_in > 0 and self.is_streaming():
+            # Local files would report the disk read rate
+            self.throughput.measure(avg_in)
         if self.buffering:
-            if buf < 20:
+            if buf < self.buffering_controller.low_percent and not self.is_paused:
+                self.buffering_controller.stalled()
                 self.pause()
-            elif buf >= 80:
+            elif buf >= self.buffering_controller.start_percent:
                 self.play()
 
     def on_pad_added(self, element, pad):
@@ -303,12 +426,12 @@ class Player(object):
         stream_flags = event.parse_stream_flags().value_names
         if string.startswith('audio/'):
             self.has_audio = True
-            if not self.pipeline.get_by_name(self.audiobin.get_name()):
+            if not self.audiobin.get_parent():
                 self.pipeline.add(self.audiobin)
             self.decodebin.link(self.audioconvert_tee)
             self.audiotee.link(self.audiobin)
             if self.add_sink:
-                self.audiotee.link(self.pipeline.get_by_name('aq'))
+                self.audiotee.link(self.add_audio_queue)
             self.audiobin.sync_state_with_parent()
         if string.startswith('video/'):
             if self.has_video or ('GST_STREAM_FLAG_SELECT' not in stream_flags and not self.has_video):
@@ -324,7 +447,7 @@ class Player(object):
         if not self.has_audio and self.add_sink:
             # Can't handle it since additional pipeline always assumes audio
             GLib.idle_add(self.on_eos, 0)
-        elif not self.has_audio:
+        elif not self.has_audio and self.audiobin.get_parent():
             self.pipeline.remove(self.audiobin)
         if not self.has_video:
             # A workaround for a bit wrongly muxed video files with no default flag on a video stream.
@@ -365,7 +488,113 @@ class Player(object):
             self.quit()
         elif keyval == Gdk.KEY_f:
             self.toggle_fullscreen()
+        elif keyval == Gdk.KEY_p:
+            self.toggle_pin()
         elif keyval == Gdk.KEY_c:
-            self.copy_to_clipboard(self.uri)
+            self.copy_to_clipboard(getattr(self.video, 'url', self.uri))
         elif keyval == Gdk.KEY_space:
             self.toggle_play()
+
+
+class GaplessPlayer(Player):
+    """
+    Player built on playbin. The next video is set from the about-to-finish
+    signal, so it is already prerolled when the current one ends and the
+    pipeline never goes through NULL between videos.
+
+    Streamed files are not teed to disk: with prefetching on, downloaded
+    copies are still saved to file_save_dir when played to the end.
+    The additional pipeline is not supported.
+    """
+    def __init__(self, *args, **kwargs):
+        self.next_video = None
+        super().__init__(*args, **kwargs)
+
+    def create_pipeline(self):
+        return Gst.ElementFactory.make('playbin', 'playbin')
+
+    def build_pipeline(self):
+        if self.add_sink:
+            self.logger.warning('Additional pipeline is not supported in gapless mode')
+        self.videobin = Gst.parse_bin_from_description('queue max-size-buffers=0 max-size-bytes=0 max-size-time=1000000000 ! '
+            + self.video_sink, True)
+        self.audiobin = Gst.parse_bin_from_description('audioconvert ! ' + \
+                ('ladspa-sc4-1882-so-sc4 ratio=5 attack-time=5 release-time=120 threshold-level=-10 ! \
+                ladspa-fast-lookahead-limiter-1913-so-fastlookaheadlimiter input-gain=10 limit=-3 ! ' if self.use_compressor
+                else '') + self.audio_sink, True)
+        self.pipeline.set_property('video-sink', self.videobin)
+        self.pipeline.set_property('audio-sink', self.audiobin)
+
+        self.pipeline.connect('about-to-finish', self.on_about_to_finish)
+        self.pipeline.connect('source-setup', self.on_source_setup)
+        self.bus.connect('message::stream-start', self.on_stream_start)
+
+    def set_buffering(self, video, uri):
+        controller = self.buffering_controller
+        controller.plan(video, 'http://' in uri or 'https://' in uri)
+        # Negative values are playbin defaults
+        self.pipeline.set_property('buffer-duration', int(controller.queue_time * Gst.SECOND) if controller.queue_time else -1)
+        self.pipeline.set_property('buffer-size', controller.queue_bytes or -1)
+
+    def is_streaming(self):
+        return bool(self.uri) and ('http://' in self.uri or 'https://' in self.uri)
+
+    def location(self, uri):
+        if 'http://' in uri or 'https://' in uri:
+            return self.proxy.url(uri) if self.proxy else uri
+        return Gst.filename_to_uri(os.path.abspath(uri))
+
+    def seturi(self, video):
+        if not video:
+            return
+        if self.prefetcher:
+            self.prefetcher.acquire(video)
+        uri = str(video)
+        self.pipeline.set_property('uri', self.location(uri))
+        self.set_buffering(video, uri)
+        self.video = video
+        self.uri = uri
+        self.update_titlebar()
+        if self.play_callback:
+            self.play_callback(uri)
+
+    def get_queued_or_random(self):
+        # A video already taken in about-to-finish goes first
+        video, self.next_video = self.next_video, None
+        return video or super().get_queued_or_random()
+
+    def on_about_to_finish(self, playbin):
+        # Called from a streaming thread
+        video = super().get_queued_or_random()
+        if not video:
+            return
+        if self.prefetcher:
+            self.prefetcher.acquire(video)
+        self.next_video = video
+        playbin.set_property('uri', self.location(str(video)))
+        self.set_buffering(video, str(video))
+
+    def on_source_setup(self, playbin, source):
+        if source.find_property('user-agent') and self.user_agent:
+            source.set_property('user-agent', self.user_agent)
+        if source.find_property('cookies') and self.cookie:
+            source.set_property('cookies', ['cf_clearance=' + self.cookie])
+
+    def on_stream_start(self, bus, msg):
+        video, self.next_video = self.next_video, None
+        if not video:
+            return
+        self.logger.debug('Switched to {}'.format(video))
+        if self.prefetcher and self.video:
+            self.prefetcher.release(self.video, True)
+        if self.cache and self.video:
+            self.cache.add(str(self.video))
+        self.video = video
+        self.uri = str(video)
+        self.logger.info('Playing {}'.format(self.uri))
+        if self.decoder and self.decoder_video is not video:
+            # playbin kept the decoder of the previous video
+            self.configure_decoder(video)
+        self.update_titlebar()
+        if self.play_callback:
+            self.play_callback(self.uri)
@@ -0,0 +1,202 @@
+# coding: utf-8
+import logging
+import os
+import os.path
+import random
+import threading
+import time
+
+
+class Library(object):
+    """
+    In-memory index of the WebM files in a directory for random picks.
+
+    Names are kept in a list with a position map, so add(), remove()
+    and random() are O(1). The directory is scanned once on start and
+    rescanned in a background thread only when its mtime changes, checked
+    at most every check_interval seconds. Changes made by the player
+    itself are reported with add(), remove() and sync(), which take the
+    new mtime as seen, so they don't cause rescans.
+
+    Random picks come from a shuffle bag: every file is played once per
+    cycle, new files join the current cycle at a random place. Files
+    played in the current cycle are journaled in BAG_NAME, so the cycle
+    continues after a restart. weight is an optional callable returning
+    a 0..1 chance to play a file now, otherwise it goes back to the bag.
+    """
+    BAG_NAME = '.shufflebag'
+    WEIGHT_ATTEMPTS = 10
+
+    def __init__(self, directory, check_interval=60, weight=None):
+        self.logger = logging.getLogger('library')
+        self.directory = os.path.abspath(directory)
+        self.bag_path = os.path.join(self.directory, self.BAG_NAME)
+        self.check_interval = check_interval
+        self.weight = weight
+        self.names = list()
+        self.positions = dict()
+        self.bag = list()
+        self.bag_positions = dict()
+        self.mtime = None
+        self.checked = 0
+        self.scanning = False
+        self.lock = threading.RLock()
+        self.scan()
+        try:
+            with open(self.bag_path) as bag:
+                for line in bag:
+                    self.bag_remove(line.rstrip('\n'))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def scan(self):
+        # The directory is listed without the lock, picks go on meanwhile
+        mtime = os.stat(self.directory).st_mtime_ns
+        found = set(entry.name for entry in os.scandir(self.directory)
+                    if entry.name.endswith('.webm') and entry.is_file())
+        with self.lock:
+            self.mtime = mtime
+            for name in [name for name in self.names if name not in found]:
+                self.delete(name)
+            for name in found:
+                self.insert(name)
+            self.logger.debug('{} files in {}'.format(len(self.names), self.directory))
+
+    def rescan(self):
+        try:
+            self.scan()
+        except OSError as e:
+            self.logger.error('Cannot scan {}: {}'.format(self.directory, e))
+        finally:
+            self.scanning = False
+
+    def refresh(self):
+        with self.lock:
+            if self.scanning or time.monotonic() - self.checked < self.check_interval:
+                return
+            self.checked = time.monotonic()
+            try:
+                changed = os.stat(self.directory).st_mtime_ns != self.mtime
+            except OSError:
+                return
+            if changed:
+                self.scanning = True
+                threading.Thread(target=self.rescan, name='library', daemon=True).start()
+
+    def sync(self):
+        """
+        Take the current directory mtime as seen after a change made by the player.
+        """
+        with self.lock:
+            try:
+                self.mtime = os.stat(self.directory).st_mtime_ns
+            except OSError:
+                pass
+
+    def add(self, name):
+        with self.lock:
+            self.insert(name)
+            self.sync()
+
+    def remove(self, name):
+        with self.lock:
+            self.delete(name)
+            self.sync()
+
+    def insert(self, name):
+        if name in self.positions:
+            return
+        self.positions[name] = len(self.names)
+        self.names.append(name)
+        self.bag_add(name)
+
+    def delete(self, name):
+        position = self.positions.pop(name, None)
+        if position is None:
+            return
+        last = self.names.pop()
+        if position < len(self.names):
+            self.names[position] = last
+            self.positions[last] = position
+        self.bag_remove(name)
+
+    def bag_add(self, name):
+        # Append and swap with a random element to keep the bag shuffled
+        position = random.randint(0, len(self.bag))
+        self.bag.append(name)
+        self.bag_positions[name] = len(self.bag) - 1
+        if position < len(self.bag) - 1:
+            self.bag_swap(position, len(self.bag) - 1)
+
+    def bag_swap(self, a, b):
+        self.bag[a], self.bag[b] = self.bag[b], self.bag[a]
+        self.bag_positions[self.bag[a]] = a
+        self.bag_positions[self.bag[b]] = b
+
+    def bag_remove(self, name):
+        position = self.bag_positions.get(name)
+        if position is None:
+            return
+        self.bag_swap(position, len(self.bag) - 1)
+        self.bag.pop()
+        del self.bag_positions[name]
+
+    def new_cycle(self):
+        self.logger.info('Every file was played, starting over')
+        self.bag = list(self.names)
+        random.shuffle(self.bag)
+        self.bag_positions = {name: position for position, name in enumerate(self.bag)}
+        try:
+            open(self.bag_path, 'w').close()
+        except OSError as e:
+            self.logger.error('Cannot reset shuffle bag: {}'.format(e))
+
+    def take(self):
+        for attempt in range(self.WEIGHT_ATTEMPTS):
+            name = self.bag[-1]
+            if not self.weight or attempt == self.WEIGHT_ATTEMPTS - 1 or \
+               random.random() < self.weight(os.path.join(self.directory, name)):
+                break
+            # Not now, put it back to a random place
+            self.bag_swap(random.randrange(len(self.bag)), len(self.bag) - 1)
+        self.bag_remove(name)
+        try:
+            with open(self.bag_path, 'a') as bag:
+                bag.write(name + '\n')
+        except OSError as e:
+            self.logger.error('Cannot write shuffle bag: {}'.format(e))
+        return name
+
+    def random(self):
+        """
+        Return path to the next file from the shuffle bag
+        or None if the directory is empty.
+        """
+        self.refresh()
+        with self.lock:
+            while self.names:
+                if not self.bag:
+                    self.new_cycle()
+                name = self.take()
+                path = os.path.join(self.directory, name)
+                if os.path.isfile(path):
+                    return path
+                self.remove(name)
+            return None
+
+
+def recency_weight(path, half_life=7 * 24 * 3600):
+    """
+    Prefer recently saved files: weight halves every half_life seconds of file age.
+    """
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return 1.0
+    return 0.5 ** (max(0, age) / half_life)
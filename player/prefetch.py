@@ -0,0 +1,421 @@
+# coding: utf-8
+import hashlib
+import json
+import logging
+import math
+import os
+import os.path
+import shutil
+import threading
+import time
+import requests
+from player.buffering import Throughput
+
+
+class PartialFile(object):
+    """
+    A file being downloaded by the prefetcher, readable while it grows.
+    length bytes of it are on disk, total is the full size if known.
+    A staged file is not active, validator is the ETag or Last-Modified
+    of the response it came from, to resume it with If-Range.
+    The file is opened for every read, so it can be renamed in between.
+    """
+    def __init__(self, path, length, total, active=True, validator=None):
+        self.path = path
+        self.length = length
+        self.total = total
+        self.active = active
+        self.validator = validator
+        self.condition = threading.Condition()
+
+    def extend(self, length):
+        with self.condition:
+            self.length = length
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+
+    def read(self, offset, size, timeout=30):
+        """
+        Return up to size bytes at offset, waiting for them while the download goes on.
+        Return an empty string if they don't come.
+        """
+        with self.condition:
+            while offset >= self.length and self.active:
+                if not self.condition.wait(timeout):
+                    break
+            if offset >= self.length:
+                return b''
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return f.read(min(size, self.length - offset))
+
+
+class Prefetcher(threading.Thread):
+    """
+    Downloads the next scheduled videos into cache_dir while the current
+    one plays. A finished download sets video.path, so the player opens
+    the local copy with filesrc instead of streaming it.
+
+    Depth follows the measured throughput: it is the ratio of the queued
+    videos' bitrate to the download rate, doubled and clamped to
+    [min_depth, max_depth], so slow links look further ahead.
+
+    A video held by the player while it is being downloaded keeps
+    downloading: the media proxy serves it from the growing file via open().
+
+    Unfinished downloads, both abandoned prefetches and files skipped by
+    the player, are kept in the staging directory with a JSON sidecar
+    recording their validated length, and resumed with a Range request.
+    Staged files older than staging_max_age seconds are removed on start,
+    the oldest ones whenever they take more than staging_max_size bytes.
+    A video played to the end is unstaged.
+
+    Files are kept in a CACHE_NAME subdirectory of cache_dir owned by the
+    prefetcher, its leftovers are removed on start.
+    """
+    CACHE_NAME = 'prefetch'
+    STAGING_NAME = 'partial'
+
+    def __init__(self, client, scheduler, cache_dir, save_dir=None, min_depth=1, max_depth=5,
+                 chunk_size=64 * 1024, staging_max_age=7 * 24 * 3600, staging_max_size=1024 ** 3,
+                 throughput=None):
+        super().__init__(name='prefetch', daemon=True)
+        self.logger = logging.getLogger('prefetch')
+        self.client = client
+        self.scheduler = scheduler
+        self.cache_dir = os.path.join(os.path.abspath(cache_dir), self.CACHE_NAME)
+        self.save_dir = save_dir
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.chunk_size = chunk_size
+        self.staging_max_size = staging_max_size
+        self.depth = min_depth
+        # Shared with the player, see player.buffering.Throughput
+        self.throughput = throughput or Throughput(scheduler)
+        # Downloaded videos by id and the ones opened by the player by id:
+        # the playing one and, in gapless mode, the next one
+        self.cached = dict()
+        self.held = dict()
+        # Videos which failed to download, not retried while queued
+        self.failed = dict()
+        # Downloads in progress by URL
+        self.downloads = dict()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.staging_dir = os.path.join(self.cache_dir, self.STAGING_NAME)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        # Leftovers of the previous run
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                os.remove(entry.path)
+        for entry in os.scandir(self.staging_dir):
+            if entry.name.endswith('.json'):
+                if entry.stat().st_mtime < time.time() - staging_max_age:
+                    self.unstage(entry.path[:-len('.json')])
+            elif not os.path.exists(entry.path + '.json'):
+                os.remove(entry.path)
+        self.trim_staging()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def cache_path(self, video):
+        return os.path.join(self.cache_dir, os.path.basename(video.url))
+
+    def update_depth(self, videos):
+        rate = self.throughput.rate
+        if not rate:
+            return
+        bitrates = [video.size * 1024 / video.duration for video in videos
+                    if getattr(video, 'size', None) and getattr(video, 'duration', None)]
+        if not bitrates:
+            return
+        ratio = sum(bitrates) / len(bitrates) / rate
+        depth = max(self.min_depth, min(self.max_depth, math.ceil(ratio * 2)))
+        if depth != self.depth:
+            self.logger.info('Prefetch depth is {} at {:.0f} KiB/s'.format(depth, rate / 1024))
+            self.depth = depth
+
+    def measure(self, size, elapsed):
+        if elapsed <= 0:
+            return
+        self.throughput.measure(size / elapsed)
+
+    def staged_length(self, partial):
+        """
+        Return the length of a staged file recorded in its sidecar and the sidecar,
+        0 and an empty dict if there is none. Bytes written after the sidecar
+        was updated are cut off. The content is checked by If-Range when it's
+        resumed and by MD5 when it's complete.
+        """
+        try:
+            with open(partial + '.json') as f:
+                sidecar = json.load(f)
+            length = sidecar['length']
+            if os.path.getsize(partial) < length:
+                raise ValueError('Staged file is shorter than its sidecar')
+            os.truncate(partial, length)
+            return length, sidecar
+        except (OSError, ValueError, KeyError, TypeError):
+            self.unstage(partial)
+            return 0, dict()
+
+    def save_sidecar(self, partial, url, length, total=None, validator=None):
+        with open(partial + '.json', 'w') as f:
+            json.dump({'url': url, 'length': length, 'total': total, 'validator': validator}, f)
+
+    def file_md5(self, path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def unstage(self, partial):
+        for path in (partial, partial + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def trim_staging(self):
+        """
+        Remove the oldest staged files until they fit in staging_max_size.
+        Files being downloaded are left alone.
+        """
+        if self.staging_max_size is None:
+            return
+        with self.lock:
+            active = set(progress.path for progress in self.downloads.values())
+        files = list()
+        for entry in os.scandir(self.staging_dir):
+            if not entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file[1] for file in files)
+        for mtime, file_size, path in sorted(files):
+            if size <= self.staging_max_size:
+                break
+            if path in active:
+                continue
+            try:
+                self.unstage(path)
+                size -= file_size
+                self.logger.debug('Removed staged {}'.format(path))
+            except OSError as e:
+                self.logger.error('Cannot remove {}: {}'.format(path, e))
+
+    def stage(self, video, location):
+        """
+        Keep a partially downloaded file instead of removing it.
+        Called by the player when a streamed video is skipped.
+        """
+        partial = os.path.join(self.staging_dir, os.path.basename(video.url))
+        with self.lock:
+            downloading = video.url in self.downloads
+        try:
+            if downloading:
+                # The prefetcher keeps its own copy
+                os.remove(location)
+                return
+            shutil.move(location, partial)
+            self.save_sidecar(partial, video.url, os.path.getsize(partial))
+            self.logger.debug('Staged {} bytes of {}'.format(os.path.getsize(partial), video.url))
+            self.trim_staging()
+        except OSError as e:
+            self.logger.error('Cannot stage {}: {}'.format(location, e))
+
+    def download(self, video):
+        path = self.cache_path(video)
+        partial = os.path.join(self.staging_dir, os.path.basename(video.url))
+        offset, sidecar = self.staged_length(partial)
+        if offset and offset == sidecar.get('total'):
+            # Complete file set aside by prune()
+            try:
+                os.replace(partial, path)
+                self.unstage(partial)
+            except OSError as e:
+                self.logger.error('Cannot restore {}: {}'.format(partial, e))
+                return False
+            with self.lock:
+                video.path = path
+                self.cached[id(video)] = video
+            self.logger.debug('Restored {} from staging'.format(video.url))
+            return True
+        headers = dict()
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if sidecar.get('validator'):
+                # Full file instead of the rest if it has changed
+                headers['If-Range'] = sidecar['validator']
+        started = time.monotonic()
+        size = 0
+        total = None
+        validator = None
+        f = None
+        progress = None
+        try:
+            with self.client.get(video.url, headers=headers, stream=True, timeout=30,
+                                 limited=False) as response:
+                if response.status_code == requests.codes.partial_content:
+                    self.logger.debug('Resuming {} from {}'.format(video.url, offset))
+                    f = open(partial, 'ab')
+                    total = int(response.headers.get('Content-Range', '/0').rpartition('/')[2] or 0)
+                elif response.status_code == requests.codes.ok:
+                    offset = 0
+                    f = open(partial, 'wb')
+                    total = int(response.headers.get('Content-Length') or 0)
+                elif response.status_code == requests.codes.requested_range_not_satisfiable:
+                    # Staged file was complete or has changed, start over
+                    self.unstage(partial)
+                    return False
+                else:
+                    self.logger.info('Cannot prefetch {}: {}'.format(video.url, response.status_code))
+                    self.failed[id(video)] = video
+                    return False
+                total = total or None
+                etag = response.headers.get('ETag')
+                # If-Range needs a strong validator
+                validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+                progress = PartialFile(partial, offset, total)
+                with self.lock:
+                    self.downloads[video.url] = progress
+                for chunk in response.iter_content(self.chunk_size):
+                    if video not in self.scheduler and id(video) not in self.held:
+                        # Removed from the queue or skipped by the player
+                        self.logger.debug('Abandoning prefetch of {}'.format(video.url))
+                        return False
+                    f.write(chunk)
+                    f.flush()
+                    size += len(chunk)
+                    progress.extend(offset + size)
+            f.close()
+            if offset and video.md5 and self.file_md5(partial) != video.md5:
+                self.logger.warning('Resumed {} does not match its MD5, downloading it again'.format(video.url))
+                self.unstage(partial)
+                return False
+            with progress.condition:
+                os.replace(partial, path)
+                progress.path = path
+            self.unstage(partial)
+        except (requests.RequestException, OSError, ValueError) as e:
+            self.logger.error('Cannot prefetch {}: {}'.format(video.url, e))
+            self.failed[id(video)] = video
+            return False
+        finally:
+            if f and not f.closed:
+                f.close()
+                self.save_sidecar(partial, video.url, offset + size, total, validator)
+            if progress:
+                with self.lock:
+                    self.downloads.pop(video.url, None)
+                progress.finish()
+            if os.path.exists(partial):
+                self.trim_staging()
+
+        self.measure(size, time.monotonic() - started)
+        with self.lock:
+            video.path = path
+            self.cached[id(video)] = video
+        self.logger.debug('Prefetched {}'.format(video.url))
+        return True
+
+    def open(self, url):
+        """
+        Return a PartialFile with the local copy of url, being downloaded,
+        complete or staged, or None.
+        """
+        with self.lock:
+            if url in self.downloads:
+                return self.downloads[url]
+            for video in self.cached.values():
+                if video.url == url and video.path and os.path.isfile(video.path):
+                    size = os.path.getsize(video.path)
+                    return PartialFile(video.path, size, size, False)
+        partial = os.path.join(self.staging_dir, os.path.basename(url))
+        length, sidecar = self.staged_length(partial)
+        if length and sidecar.get('url') == url:
+            return PartialFile(partial, length, sidecar.get('total'), False, sidecar.get('validator'))
+        return None
+
+    def prune(self, upcoming):
+        """
+        Drop cached files of videos which are neither upcoming nor playing.
+        Files of videos still queued further away are moved to staging,
+        so they are restored without downloading when they come up again.
+        """
+        keep = set(id(video) for video in upcoming)
+        self.failed = {key: video for key, video in self.failed.items() if key in keep}
+        with self.lock:
+            stale = [video for key, video in self.cached.items() if key not in keep and key not in self.held]
+            paths = list()
+            for video in stale:
+                del self.cached[id(video)]
+                paths.append((video, video.path))
+                video.path = None
+        for video, path in paths:
+            try:
+                if video in self.scheduler:
+                    partial = os.path.join(self.staging_dir, os.path.basename(video.url))
+                    size = os.path.getsize(path)
+                    os.replace(path, partial)
+                    self.save_sidecar(partial, video.url, size, size)
+                    self.trim_staging()
+                else:
+                    os.remove(path)
+            except OSError as e:
+                self.logger.error('Cannot remove {}: {}'.format(path, e))
+
+    def acquire(self, video):
+        """
+        Called by the player when it opens a video. Held videos are
+        not pruned until they are released.
+        """
+        with self.lock:
+            self.held[id(video)] = video
+        self.wake()
+
+    def release(self, video, keep=False):
+        """
+        Called by the player when it's done with a video.
+        A cached copy of a video played to the end is moved to save_dir if keep is set,
+        removed otherwise. Its staged copy is no longer needed then.
+        """
+        if keep:
+            with self.lock:
+                downloading = video.url in self.downloads
+            if not downloading:
+                try:
+                    self.unstage(os.path.join(self.staging_dir, os.path.basename(video.url)))
+                except OSError as e:
+                    self.logger.error('Cannot unstage {}: {}'.format(video.url, e))
+        with self.lock:
+            self.held.pop(id(video), None)
+            if self.cached.pop(id(video), None) is None:
+                return
+            path = video.path
+            video.path = None
+        try:
+            target = os.path.join(self.save_dir, os.path.basename(video.url)) if self.save_dir else None
+            if keep and target and not os.path.exists(target):
+                shutil.move(path, target)
+                video.path = target
+            else:
+                os.remove(path)
+        except OSError as e:
+            self.logger.error('Cannot release {}: {}'.format(path, e))
+
+    def run(self):
+        while True:
+            upcoming = self.scheduler.peek(self.max_depth)
+            self.prune(upcoming)
+            self.update_depth(upcoming)
+            for video in upcoming[:self.depth]:
+                if getattr(video, 'url', None) and not video.path and id(video) not in self.failed:
+                    self.download(video)
+                    break
+            else:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
@@ -0,0 +1,172 @@
+# coding: utf-8
+import http.server
+import logging
+import mimetypes
+import re
+import threading
+import urllib.parse
+import requests
+import urllib3
+
+# Response headers passed from upstream to the player
+FORWARD_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Content-Encoding',
+                   'Accept-Ranges', 'Last-Modified', 'ETag')
+
+
+class MediaProxy(object):
+    """
+    Local HTTP server handing media downloads over to the players.
+
+    Players open http://127.0.0.1:<port>/<quoted URL> and the request is made
+    through the shared pooled client, so every video start reuses a kept-alive
+    upstream connection instead of a fresh TCP and TLS handshake per element.
+    Only URLs on allowed_hosts and their subdomains are served, the client
+    carries the board cookie and User-Agent.
+
+    With a prefetcher, videos it has on disk, staged or is downloading are
+    served from the local file and the rest, if any, is requested with Range.
+    """
+    def __init__(self, client, allowed_hosts, prefetcher=None, host='127.0.0.1', port=0,
+                 chunk_size=64 * 1024):
+        self.logger = logging.getLogger('proxy')
+        self.server = http.server.ThreadingHTTPServer((host, port), MediaProxyHandler)
+        self.server.daemon_threads = True
+        self.server.client = client
+        self.server.allowed_hosts = tuple(allowed_hosts)
+        self.server.prefetcher = prefetcher
+        self.server.chunk_size = chunk_size
+        self.server.logger = self.logger
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='proxy', daemon=True)
+        self.thread.start()
+        self.logger.info('Media proxy is listening on {}:{}'.format(self.host, self.port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, uri):
+        return 'http://{}:{}/{}'.format(self.host, self.port, urllib.parse.quote(uri, safe=''))
+
+
+class MediaProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+    def do_GET(self):
+        uri = urllib.parse.unquote(self.path[1:])
+        if not uri.startswith(('http://', 'https://')):
+            self.send_error(400)
+            return
+        host = urllib.parse.urlsplit(uri).hostname or ''
+        if not any(host == allowed or host.endswith('.' + allowed) for allowed in self.server.allowed_hosts):
+            self.server.logger.warning('Refusing to proxy {}'.format(uri))
+            self.send_error(403)
+            return
+
+        # Only open-ended ranges are served locally, that's what players send
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', '').strip())
+        start = int(match.group(1)) if match else None
+        if start is not None or not self.headers.get('Range'):
+            local = self.server.prefetcher.open(uri) if self.server.prefetcher else None
+            if local and local.active and local.total and (start or 0) < local.total:
+                self.send_local(uri, local, start)
+                return
+            if local and not local.active and (start or 0) < local.length:
+                self.send_local(uri, local, start)
+                return
+        self.send_upstream(uri)
+
+    def send_local(self, uri, local, start):
+        offset = start or 0
+        total = local.total
+        upstream = None
+        if not local.active and (total is None or local.length < total):
+            # Staged prefix: open the rest first, it tells the size and whether the prefix is still valid
+            headers = {'Range': 'bytes={}-'.format(local.length)}
+            if local.validator:
+                headers['If-Range'] = local.validator
+            try:
+                upstream = self.server.client.get(uri, headers=headers, stream=True, timeout=30, limited=False)
+                total = int(upstream.headers.get('Content-Range', '/').rpartition('/')[2])
+            except (requests.RequestException, ValueError) as e:
+                self.server.logger.debug('Cannot resume {}: {}'.format(uri, e))
+                total = None
+            if upstream is not None and (total is None or upstream.status_code != requests.codes.partial_content):
+                upstream.close()
+            if total is None or upstream.status_code != requests.codes.partial_content:
+                self.server.logger.debug('Staged copy of {} is not usable'.format(uri))
+                self.send_upstream(uri)
+                return
+            self.server.logger.debug('Serving {} staged bytes of {}'.format(local.length, uri))
+
+        self.send_response(206 if start is not None else 200)
+        self.send_header('Content-Type', mimetypes.guess_type(uri)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(total - offset))
+        self.send_header('Accept-Ranges', 'bytes')
+        if start is not None:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(offset, total - 1, total))
+        self.end_headers()
+        try:
+            if upstream is not None:
+                with upstream:
+                    while offset < local.length:
+                        chunk = local.read(offset, self.server.chunk_size)
+                        if not chunk:
+                            raise OSError('Staged file is shorter than expected')
+                        self.wfile.write(chunk)
+                        offset += len(chunk)
+                    for chunk in upstream.raw.stream(self.server.chunk_size, decode_content=False):
+                        self.wfile.write(chunk)
+                return
+            while offset < total:
+                chunk = local.read(offset, self.server.chunk_size)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                offset += len(chunk)
+            if offset < total:
+                # Local copy ended early, get the rest
+                self.server.logger.debug('Requesting {} from {}'.format(uri, offset))
+                with self.server.client.get(uri, headers={'Range': 'bytes={}-'.format(offset)}, stream=True,
+                                            timeout=30, limited=False) as upstream:
+                    if upstream.status_code != requests.codes.partial_content:
+                        raise requests.RequestException('Range request failed with {}'.format(upstream.status_code))
+                    for chunk in upstream.raw.stream(self.server.chunk_size, decode_content=False):
+                        self.wfile.write(chunk)
+        except (ConnectionError, OSError, urllib3.exceptions.HTTPError, requests.RequestException) as e:
+            self.server.logger.debug('Stopped streaming {}: {}'.format(uri, e))
+            self.close_connection = True
+
+    def send_upstream(self, uri):
+        headers = dict()
+        if self.headers.get('Range'):
+            headers['Range'] = self.headers['Range']
+        try:
+            upstream = self.server.client.get(uri, headers=headers, stream=True, timeout=30,
+                                                  limited=False)
+        except requests.RequestException as e:
+            self.server.logger.error('Cannot open {}: {}'.format(uri, e))
+            self.send_error(502)
+            return
+
+        with upstream:
+            self.send_response(upstream.status_code)
+            for header in FORWARD_HEADERS:
+                if header in upstream.headers:
+                    self.send_header(header, upstream.headers[header])
+            if 'Content-Length' not in upstream.headers:
+                self.close_connection = True
+            self.end_headers()
+            try:
+                for chunk in upstream.raw.stream(self.server.chunk_size, decode_content=False):
+                    self.wfile.write(chunk)
+            except (ConnectionError, urllib3.exceptions.HTTPError) as e:
+                # Player stopped reading, e.g. the video was skipped
+                self.server.logger.debug('Stopped streaming {}: {}'.format(uri, e))
+                self.close_connection = True
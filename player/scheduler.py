@@ -0,0 +1,127 @@
+# coding: utf-8
+import heapq
+import itertools
+import logging
+import queue
+import threading
+
+POLICIES = ('fifo', 'newest', 'smallest', 'roundrobin')
+
+
+class Scheduler(object):
+    """
+    Heap-based play queue replacing queue.Queue in the players.
+
+    Items are updater.updater.Video records or plain paths. The order
+    depends on the policy:
+      fifo        in order of arrival
+      newest      most recently found first
+      smallest    smallest files first while bandwidth is below
+                  low_bandwidth (bytes per second), in order of arrival otherwise
+      roundrobin  one video of every thread in turn
+
+    put(), get_nowait() and cancel() are O(log n), cancelled entries
+    are dropped lazily when they reach the top of the heap.
+    """
+    def __init__(self, policy='fifo', low_bandwidth=256 * 1024):
+        if policy not in POLICIES:
+            raise ValueError('Unknown scheduler policy: {}'.format(policy))
+        self.logger = logging.getLogger('scheduler')
+        self.policy = policy
+        self.low_bandwidth = low_bandwidth
+        self.bandwidth = None
+        self.heap = list()
+        self.entries = dict()
+        self.size = 0
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # Round-robin state: next round of every thread and the current one
+        self.thread_rounds = dict()
+        self.round = 0
+
+    def is_bandwidth_low(self):
+        return self.bandwidth is not None and self.bandwidth < self.low_bandwidth
+
+    def key(self, item, seq):
+        if self.policy == 'newest':
+            return (-seq,)
+        if self.policy == 'smallest' and self.is_bandwidth_low():
+            return (getattr(item, 'size', None) or 0, seq)
+        if self.policy == 'roundrobin':
+            thread = (getattr(item, 'board', None), getattr(item, 'thread', None))
+            rnd = max(self.thread_rounds.get(thread, 0), self.round)
+            self.thread_rounds[thread] = rnd + 1
+            return (rnd, seq)
+        return (seq,)
+
+    def put(self, item):
+        with self.lock:
+            seq = next(self.counter)
+            entry = [self.key(item, seq), seq, item, True]
+            self.entries[id(item)] = entry
+            self.size += 1
+            heapq.heappush(self.heap, entry)
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def get_nowait(self):
+        with self.lock:
+            while self.heap:
+                key, seq, item, valid = heapq.heappop(self.heap)
+                if not valid:
+                    continue
+                self.size -= 1
+                if self.entries.get(id(item), [None, seq])[1] == seq:
+                    del self.entries[id(item)]
+                if self.policy == 'roundrobin':
+                    self.round = key[0]
+                return item
+        raise queue.Empty
+
+    def cancel(self, item):
+        """
+        Remove a queued item, return whether it was queued.
+        """
+        with self.lock:
+            entry = self.entries.pop(id(item), None)
+            if entry is None:
+                return False
+            entry[3] = False
+            self.size -= 1
+            return True
+
+    def peek(self, count=1):
+        """
+        Return up to count next items without removing them.
+        """
+        with self.lock:
+            return [entry[2] for entry in heapq.nsmallest(count, (entry for entry in self.heap if entry[3]))]
+
+    def __contains__(self, item):
+        with self.lock:
+            return id(item) in self.entries
+
+    def qsize(self):
+        with self.lock:
+            return self.size
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def set_bandwidth(self, bandwidth):
+        """
+        Report measured download rate in bytes per second.
+        Crossing low_bandwidth with the smallest policy reorders the queue in O(n).
+        """
+        with self.lock:
+            was_low = self.is_bandwidth_low()
+            self.bandwidth = bandwidth
+            if self.policy != 'smallest' or was_low == self.is_bandwidth_low():
+                return
+            self.logger.info('Bandwidth is {}, reordering queue'.format(
+                'low' if self.is_bandwidth_low() else 'back to normal'))
+            self.heap = [entry for entry in self.heap if entry[3]]
+            for entry in self.heap:
+                entry[0] = self.key(entry[2], entry[1])
+            heapq.heapify(self.heap)
@@ -13,6 +13,8 @@ import logging
 import glob
 import player.vlcbind.vlc as vlc
 import ctypes
+from player.scheduler import Scheduler
+from player.buffering import Throughput
 import threading
 
 GObject.threads_init()
@@ -23,7 +25,8 @@ class NoDirectoryException(Exception):
 
 
 class Player(object):
-    def __init__(self, file_save_dir=None, use_compressor=False, video_sink=None, audio_sink=None):
+    def __init__(self, file_save_dir=None, use_compressor=False, video_sink=None, audio_sink=None,
+                 scheduler_policy='fifo'):
         self.logger = logging.getLogger('video')
         self.window = Gtk.Window()
         self.window.connect('destroy', self.quit)
@@ -46,7 +49,8 @@ class Player(object):
         self.vlc = self.instance.media_player_new()
 
         # Add video queue
-        self.videoqueue = queue.Queue()
+        self.videoqueue = Scheduler(scheduler_policy)
+        self.throughput = Throughput(self.videoqueue)
         self.randomdir = None
         self.file_save_dir = file_save_dir
         self.use_compressor = use_compressor
@@ -55,14 +59,27 @@ class Player(object):
         self.window_is_fullscreen = False
         self.is_paused = True
         self.uri = None
+        self.video = None
         self.empty_queue_callback = None
+        self.play_callback = None
+        self.proxy = None
+        self.prefetcher = None
+        self.cache = None
+        self.library = None
         self.user_agent = None
         self.cookie = None
         self.thread_queue = queue.Queue()
         self.thread = threading.Thread(target=self.on_eos_thread).start()
 
-    def seturi(self, uri):
-        media = self.instance.media_new(uri)
+    def seturi(self, video):
+        # Queue holds updater.updater.Video records or plain paths
+        if self.prefetcher:
+            self.prefetcher.acquire(video)
+        uri = str(video)
+        if self.proxy and ('http://' in uri or 'https://' in uri):
+            media = self.instance.media_new(self.proxy.url(uri))
+        else:
+            media = self.instance.media_new(uri)
         if ('http://' in uri or 'https://' in uri) and self.file_save_dir \
             and not os.path.isfile(self.file_save_dir + '/' + os.path.basename(uri)):
                 media.add_option(':sout=#duplicate{dst=display,dst=std{access=file,dst="' +\
@@ -70,7 +87,10 @@ class Player(object):
         
         self.vlc.set_media(media)
         self.window.set_title('Endless Sosuch | ' + os.path.basename(uri))
+        self.video = video
         self.uri = uri
+        if self.play_callback:
+            self.play_callback(uri)
 
     def run(self):
         self.window.show_all()
@@ -119,6 +139,15 @@ class Player(object):
         if should_delete and ('http://' in self.uri or 'https://' in self.uri) \
             and self.file_save_dir:
                 os.remove(self.file_save_dir + '/' + os.path.basename(self.uri))
+                if self.library:
+                    self.library.sync()
+        if self.prefetcher and self.video:
+            self.prefetcher.release(self.video, not should_delete)
+        if self.cache and self.video and not should_delete:
+            if ('http://' in self.uri or 'https://' in self.uri) and self.file_save_dir:
+                self.cache.add(self.file_save_dir + '/' + os.path.basename(self.uri))
+            else:
+                self.cache.add(str(self.video))
     
     def quit(self, window = None):
         self.stop(True)
@@ -136,7 +165,15 @@ class Player(object):
     def register_on_video_queue_empty_callback(self, callback):
         self.empty_queue_callback = callback
 
+    def register_on_play_callback(self, callback):
+        self.play_callback = callback
+
     def get_random(self):
+        if self.library:
+            video = self.library.random()
+            if not video:
+                self.logger.error('Directory with random files is empty!')
+            return video
         if self.randomdir is None:
             raise NoDirectoryException('Directory path is not set!')
         try:
@@ -164,6 +201,12 @@ class Player(object):
         #self.window.resize(*self.window.get_size())
         self.window.show_all()
 
+    def toggle_pin(self):
+        if not self.cache or not self.uri:
+            return
+        name = os.path.basename(self.uri)
+        self.logger.info('{} {}'.format('Pinned' if self.cache.pin(name) else 'Unpinned', name))
+
     def toggle_play(self):
         if not self.is_paused:
             self.pause()
@@ -210,6 +253,8 @@ class Player(object):
             # get random video from folder
         elif ev.keyval == Gdk.KEY_Escape or ev.keyval == Gdk.KEY_q or ev.keyval == Gdk.KEY_Q:
             self.quit()
+        elif ev.keyval == Gdk.KEY_p or ev.keyval == Gdk.KEY_P:
+            self.toggle_pin()
         elif ev.keyval == Gdk.KEY_f or ev.keyval == Gdk.KEY_F:
             self.toggle_fullscreen()
         elif ev.keyval == Gdk.KEY_space:
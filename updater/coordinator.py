@@ -0,0 +1,55 @@
+# coding: utf-8
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+
+
+class Coordinator(object):
+    """
+    Updates several boards concurrently and merges their new videos
+    into one list, interleaving the boards.
+
+    Every board is updated at most every board.interval seconds
+    and downloads its threads with its own board.workers limit.
+    The boards share one set of seen MD5s, so a video posted
+    on several boards is queued once, and one index of saved files
+    per directory.
+    """
+    def __init__(self, boards):
+        self.logger = logging.getLogger('coordinator')
+        self.boards = list(boards)
+        self.next_update = {board.board: 0 for board in self.boards}
+        self.seen_md5 = set()
+        self.seen_lock = threading.Lock()
+        saved_files = dict()
+        for board in self.boards:
+            self.seen_md5.update(board.seen_md5)
+            board.seen_md5 = self.seen_md5
+            board.seen_lock = self.seen_lock
+            if board.saved_files:
+                board.saved_files = saved_files.setdefault(board.saved_files.directory, board.saved_files)
+
+    def update_board(self, board):
+        try:
+            board.update()
+            board.find_threads()
+            board.parse_threads()
+            return board.get_new_videos_list()
+        except Exception:
+            self.logger.exception('Cannot update /{}/'.format(board.board))
+            return []
+
+    def update(self):
+        now = time.monotonic()
+        due = [board for board in self.boards if self.next_update[board.board] <= now]
+        if not due:
+            return []
+        for board in due:
+            self.next_update[board.board] = now + board.interval
+
+        self.logger.debug('Updating {}'.format(', '.join('/{}/'.format(board.board) for board in due)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(due)) as executor:
+            results = list(executor.map(self.update_board, due))
+        return [video for videos in itertools.zip_longest(*results) for video in videos if video is not None]
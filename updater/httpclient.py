@@ -0,0 +1,86 @@
+# coding: utf-8
+import logging
+import urllib.parse
+import requests
+
+
+def is_throttled(response):
+    """
+    Whether the response asks us to slow down: 429, 503
+    or a Cloudflare challenge page.
+    """
+    if response.status_code in (requests.codes.too_many_requests, requests.codes.service_unavailable):
+        return True
+    return response.status_code == requests.codes.forbidden and \
+        response.headers.get('cf-mitigated') == 'challenge'
+
+
+class Client(requests.Session):
+    """
+    Connection-pooled HTTP client shared by the updater, the prefetcher
+    and the media proxy.
+
+    Every host gets a pool of up to pool_size kept-alive connections,
+    requests over the limit wait for a free connection, so TCP and TLS
+    setup is paid once per connection, not once per request.
+
+    get(url, conditional=True) remembers ETag and Last-Modified of the URL
+    and revalidates them on the next request. Unchanged resources are
+    answered with 304 Not Modified and empty body.
+
+    With a RateLimiter every request waits for a token of its host
+    and throttled requests are retried after a backoff. Media downloads
+    pass limited=False and bypass the limiter, so a video start never
+    waits behind thread refreshes.
+    """
+    def __init__(self, pool_size=8, limiter=None):
+        super().__init__()
+        self.logger = logging.getLogger('http')
+        self.limiter = limiter
+        self.validators = dict()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, *args, limited=True, **kwargs):
+        if not self.limiter or not limited:
+            return super().request(method, url, *args, **kwargs)
+
+        host = urllib.parse.urlsplit(url).hostname
+        for attempt in range(self.limiter.retries + 1):
+            self.limiter.acquire(host)
+            response = super().request(method, url, *args, **kwargs)
+            if not is_throttled(response):
+                break
+            delay = self.limiter.penalize(host, attempt, response.headers.get('Retry-After'))
+            self.logger.warning('{} throttled with {}, backing off for {:.1f}s'.format(
+                host, response.status_code, delay))
+            if attempt < self.limiter.retries:
+                response.close()
+        return response
+
+    def forget(self, url):
+        """
+        Drop the remembered validators of a URL which won't be requested again.
+        """
+        self.validators.pop(url, None)
+
+    def get(self, url, conditional=False, **kwargs):
+        if not conditional:
+            return super().get(url, **kwargs)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        response = super().get(url, headers=headers, **kwargs)
+        if response.status_code == requests.codes.ok:
+            validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            if any(validators):
+                self.validators[url] = validators
+        elif response.status_code != requests.codes.not_modified:
+            self.validators.pop(url, None)
+        return response
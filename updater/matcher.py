@@ -0,0 +1,88 @@
+# coding: utf-8
+import re
+
+# Global inline flags at the start of a pattern, e.g. (?i)
+GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+# Group references which would point elsewhere in a combined expression
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _scoped(pattern):
+    """
+    Turn a pattern into a group which can be combined with others.
+    Global inline flags are only allowed at the start of a whole
+    expression, so they become scoped ones: (?i)abc -> (?i:abc)
+    """
+    if isinstance(pattern, re.Pattern):
+        flags = ''.join(letter for flag, letter in ((re.I, 'i'), (re.M, 'm'), (re.S, 's'), (re.X, 'x'))
+                        if pattern.flags & flag)
+        pattern = pattern.pattern
+    else:
+        flags = ''
+    match = GLOBAL_FLAGS.match(pattern)
+    if match:
+        flags += ''.join(letter for letter in match.group(1) if letter in 'imsx')
+        pattern = pattern[match.end():]
+    return '(?{}:{})'.format(flags, pattern)
+
+
+def _is_standalone(pattern):
+    """
+    Whether a pattern has to be compiled on its own: named groups clash and
+    numbered backreferences shift once patterns are combined.
+    Raises re.error for an invalid pattern.
+    """
+    compiled = re.compile(pattern)
+    return bool(compiled.groupindex) or bool(BACKREFERENCE.search(compiled.pattern))
+
+
+def _as_list(patterns):
+    if not patterns:
+        return []
+    if isinstance(patterns, (str, re.Pattern)):
+        return [patterns]
+    return list(patterns)
+
+
+class Matcher(object):
+    """
+    Include/exclude keyword filter which scans the text once.
+
+    include and exclude are regular expressions or lists of them.
+    All of them are compiled into one expression of zero-width alternatives,
+    exclusions first, so every position of the text is tried exactly once
+    and the scan stops at the first exclusion.
+    A text matches if it contains any include pattern (or there are none)
+    and no exclude pattern.
+    Patterns with named groups or backreferences are searched separately.
+    """
+    def __init__(self, include=None, exclude=None):
+        include = _as_list(include)
+        exclude = _as_list(exclude)
+        self.has_include = bool(include)
+        self.standalone_include = [re.compile(p) for p in include if _is_standalone(p)]
+        self.standalone_exclude = [re.compile(p) for p in exclude if _is_standalone(p)]
+        include = [p for p in include if not _is_standalone(p)]
+        exclude = [p for p in exclude if not _is_standalone(p)]
+        self.has_exclude = bool(exclude)
+
+        alternatives = list()
+        if exclude:
+            alternatives.append('(?=(?P<exclude>{}))'.format('|'.join(_scoped(p) for p in exclude)))
+        if include:
+            alternatives.append('(?=(?P<include>{}))'.format('|'.join(_scoped(p) for p in include)))
+        self.regex = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def match(self, text):
+        if any(regex.search(text) for regex in self.standalone_exclude):
+            return False
+
+        included = not self.has_include
+        if self.regex:
+            for match in self.regex.finditer(text):
+                if self.has_exclude and match.group('exclude') is not None:
+                    return False
+                included = True
+                if not self.has_exclude:
+                    break
+        return included or any(regex.search(text) for regex in self.standalone_include)
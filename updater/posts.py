@@ -0,0 +1,112 @@
+# coding: utf-8
+"""
+Field-projecting JSON parser for board and thread payloads.
+
+Only POST_FIELDS of every post and FILE_FIELDS of its files are extracted.
+If ijson is installed, posts are read straight from the raw response bytes
+without building the whole document. Otherwise the document is decoded
+with json and projected afterwards.
+"""
+import collections
+import io
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+POST_FIELDS = ('num', 'comment', 'lasthit', 'posts_count')
+FILE_FIELDS = ('path', 'name', 'md5', 'size', 'width', 'height', 'duration', 'duration_secs')
+
+Post = collections.namedtuple('Post', POST_FIELDS + ('files',))
+File = collections.namedtuple('File', FILE_FIELDS)
+
+# Location of posts in the different payloads
+CATALOG_THREADS = 'threads.item'
+THREAD_POSTS = 'threads.item.posts.item'
+POSTS_AFTER = 'item'
+
+
+class ParseError(Exception):
+    pass
+
+
+def iter_posts(content, prefix):
+    """
+    Yield a Post for every object found at the ijson-style prefix
+    in content (bytes).
+    """
+    if ijson is None:
+        return _iter_posts_json(content, prefix)
+    return _iter_posts_ijson(content, prefix)
+
+
+def _project_file(fields):
+    return File._make(fields.get(field) for field in FILE_FIELDS)
+
+
+def _project_post(fields, files):
+    return Post._make([fields.get(field) for field in POST_FIELDS] + [tuple(files)])
+
+
+def _iter_posts_ijson(content, prefix):
+    array_prefix = prefix.rpartition('.')[0]
+    file_prefix = prefix + '.files.item'
+    post_keys = {prefix + '.' + field: field for field in POST_FIELDS}
+    file_keys = {file_prefix + '.' + field: field for field in FILE_FIELDS}
+
+    found = False
+    post = None
+    postfile = None
+    files = None
+    try:
+        for path, event, value in ijson.parse(io.BytesIO(content), use_float=True):
+            if path == array_prefix and event == 'start_array':
+                found = True
+            elif path == prefix:
+                if event == 'start_map':
+                    post = dict()
+                    files = list()
+                elif event == 'end_map':
+                    yield _project_post(post, files)
+            elif path == file_prefix:
+                if event == 'start_map':
+                    postfile = dict()
+                elif event == 'end_map':
+                    files.append(_project_file(postfile))
+            elif path in post_keys:
+                post[post_keys[path]] = value
+            elif path in file_keys:
+                postfile[file_keys[path]] = value
+    except ijson.JSONError as e:
+        raise ParseError(e)
+
+    if not found:
+        raise ParseError('No posts at {}'.format(prefix))
+
+
+def _iter_nodes(node, keys):
+    if not keys:
+        yield node
+        return
+    if keys[0] == 'item':
+        for item in node:
+            yield from _iter_nodes(item, keys[1:])
+    else:
+        yield from _iter_nodes(node[keys[0]], keys[1:])
+
+
+def _iter_posts_json(content, prefix):
+    try:
+        document = json.loads(content.decode('utf-8'))
+        arrays = list(_iter_nodes(document, prefix.split('.')[:-1]))
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        raise ParseError(e)
+    if not all(isinstance(array, list) for array in arrays):
+        raise ParseError('No posts at {}'.format(prefix))
+
+    for array in arrays:
+        for post in array:
+            files = [_project_file(postfile) for postfile in post.get('files') or ()]
+            yield _project_post(post, files)
@@ -0,0 +1,96 @@
+# coding: utf-8
+import email.utils
+import logging
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average and up to burst at once.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def parse_retry_after(value):
+    """
+    Return Retry-After header value in seconds or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """
+    Per-host token buckets with shared exponential backoff.
+
+    Every request to a host takes a token from its bucket. When the host
+    throttles us, the whole host is blocked for Retry-After seconds or
+    for an exponentially growing delay with full jitter, so concurrent
+    requests wait together instead of failing in a burst.
+    hosts maps host names to (rate, burst) overriding the defaults.
+    """
+    def __init__(self, rate=2, burst=5, hosts=None, retries=4, backoff=1.0, max_backoff=120.0):
+        self.logger = logging.getLogger('ratelimit')
+        self.rate = rate
+        self.burst = burst
+        self.hosts = hosts or dict()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.buckets = dict()
+        self.blocked_until = dict()
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(*self.hosts.get(host, (self.rate, self.burst)))
+            return self.buckets[host]
+
+    def acquire(self, host):
+        while True:
+            with self.lock:
+                wait = self.blocked_until.get(host, 0) - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self.bucket(host).acquire()
+
+    def penalize(self, host, attempt, retry_after=None):
+        """
+        Block the host after a throttled response, return the delay.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        with self.lock:
+            self.blocked_until[host] = max(self.blocked_until.get(host, 0), time.monotonic() + delay)
+        return delay
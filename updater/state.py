@@ -0,0 +1,93 @@
+# coding: utf-8
+import os.path
+import sqlite3
+import threading
+import logging
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS threads (
+    board TEXT NOT NULL,
+    num TEXT NOT NULL,
+    url TEXT NOT NULL,
+    last_num INTEGER NOT NULL DEFAULT 0,
+    lasthit INTEGER,
+    posts_count INTEGER,
+    incremental INTEGER NOT NULL DEFAULT 1,
+    changed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (board, num)
+);
+CREATE TABLE IF NOT EXISTS files (
+    md5 TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    name TEXT,
+    size INTEGER,
+    seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    uri TEXT NOT NULL,
+    played REAL NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_name ON history (name);
+'''
+
+
+class State(object):
+    """
+    Persistent updater state in SQLite: tracked threads, seen files
+    and playback history. The database is opened in WAL mode and shared
+    between the updater and player threads.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger('state')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def load_threads(self, board):
+        with self.lock:
+            return self.db.execute('SELECT num, url, last_num, lasthit, posts_count, incremental, changed '
+                                   'FROM threads WHERE board = ? ORDER BY rowid', (board,)).fetchall()
+
+    def save_threads(self, board, threads):
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO threads '
+                                '(board, num, url, last_num, lasthit, posts_count, incremental, changed) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(board, thread.num, thread.url, thread.last_num, thread.lasthit,
+                                  thread.posts_count, thread.incremental, thread.changed) for thread in threads])
+
+    def remove_threads(self, board, nums):
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM threads WHERE board = ? AND num = ?',
+                                [(board, num) for num in nums])
+
+    def load_files(self):
+        with self.lock:
+            return set(row[0] for row in self.db.execute('SELECT md5 FROM files'))
+
+    def add_files(self, videos):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO files (md5, url, name, size, seen) VALUES (?, ?, ?, ?, ?)',
+                                [(video.md5, video.url, video.name, video.size, now) for video in videos])
+
+    def add_history(self, uri):
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO history (uri, played, name) VALUES (?, ?, ?)',
+                            (uri, time.time(), os.path.basename(uri)))
+
+    def play_count(self, name):
+        """
+        Return how many times a file with this name was played, from any location.
+        """
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM history WHERE name = ?', (name,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,27 +1,140 @@
 # coding: utf-8
 import requests
-import json
+import concurrent.futures
+import collections
 import re
 import logging
+import os.path
 import sys
+import threading
+from updater import posts
+from updater.httpclient import Client
+from updater.matcher import Matcher
 
-URL = 'https://2ch.hk/b/index.json'
+BOARD = 'b'
+DEFAULT_INCLUDE = r'([Ww][Ee][Bb][Mm])|([Цц][Уу][Ии][Ьь])|([ВвШш][Ее][Бб][Мм])'
 BASEURL = 'https://2ch.hk'
-BASEURL_BOARD = 'https://2ch.hk/b'
 if sys.platform == 'win32':
     # GnuTLS crashes on HTTPS, dunno why.
-    BASEURL = 'http://2ch.hk/b'
-    BASEURL_BOARD = 'http://2ch.hk/b'
+    BASEURL = 'http://2ch.hk'
+URL_CATALOG = BASEURL + '/{board}/catalog.json'
+URL_THREAD = BASEURL + '/{board}{url}'
+# Posts of a thread starting from the given post number
+URL_POSTS_AFTER = BASEURL + '/makaba/mobile.fcgi?task=get_thread&board={board}&thread={thread}&num={num}'
+
+def parse_duration(value):
+    """
+    Convert board's "HH:MM:SS" duration to seconds.
+    """
+    try:
+        seconds = 0
+        for part in value.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except (AttributeError, ValueError):
+        return None
+
+class Video(object):
+    """
+    Video file found on a board with the metadata reported by the board API.
+    size is in kilobytes, duration in seconds.
+    path is set if there is a local copy of the file.
+    """
+    __slots__ = ('url', 'md5', 'size', 'name', 'duration', 'width', 'height', 'board', 'thread', 'path')
+
+    def __init__(self, url, md5=None, size=None, name=None, duration=None, width=None, height=None,
+                 board=None, thread=None, path=None):
+        self.url = url
+        self.md5 = md5
+        self.size = size
+        self.name = name
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.board = board
+        self.thread = thread
+        self.path = path
+
+    def __str__(self):
+        return self.path or self.url
+
+    def __repr__(self):
+        return 'Video({!r}, md5={!r}, size={!r}, duration={!r}, {}x{})'.format(
+            self.url, self.md5, self.size, self.duration, self.width, self.height)
+
+class SavedFiles(object):
+    """
+    Index of the files saved by the player, by MD5 of their content.
+    Kept as "md5 filename" lines in INDEX_NAME inside the directory,
+    later lines override earlier ones. One instance per directory
+    is shared by the boards, see Coordinator.
+    """
+    INDEX_NAME = '.md5index'
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger('saved')
+        self.directory = os.path.abspath(directory)
+        self.path = os.path.join(self.directory, self.INDEX_NAME)
+        self.files = dict()
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as index:
+                for line in index:
+                    md5, _, name = line.rstrip('\n').partition(' ')
+                    self.files[md5] = name
+        except FileNotFoundError:
+            pass
+
+    def get(self, md5, size=None):
+        """
+        Return path to the saved file with given MD5 or None.
+        size is in kilobytes, as reported by the board.
+        """
+        with self.lock:
+            name = self.files.get(md5)
+        if not name:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            if size and abs(os.path.getsize(path) // 1024 - int(size)) > 1:
+                # Partially written file
+                return None
+        except OSError:
+            return None
+        return path
+
+    def add(self, md5, name):
+        with self.lock:
+            if self.files.get(md5) == name:
+                return
+            self.files[md5] = name
+            try:
+                with open(self.path, 'a') as index:
+                    index.write('{} {}\n'.format(md5, name))
+            except OSError as e:
+                self.logger.error('Cannot write MD5 index: {}'.format(e))
 
 class Thread(object):
-    def __init__(self, url=None):
+    def __init__(self, url=None, incremental=False, board=BOARD):
         self.logger = logging.getLogger('thread')
+        self.board = board
         self.url = url
+        self.num = re.sub(r'\D', '', url) if url else None
         self.data = None
+        self.data_prefix = posts.THREAD_POSTS
+        self.modified = True
+        self.incremental = incremental
+        self.last_num = 0
+        # Bump time and post count from the catalog, the thread
+        # is downloaded only if they change
+        self.lasthit = None
+        self.posts_count = None
+        self.changed = True
+        # Append-only log of found videos and the position
+        # of the first one not returned by get_new_videos_list() yet
         self.videos = list()
+        self.videos_cursor = 0
         self.lastupdated = None
-        self.old_latest_video_index = -1
-        self.latest_video_index = -1
 
     def __str__(self):
         return self.url
@@ -32,88 +145,232 @@ class Thread(object):
     def __eq__(self, other):
         return self.url == other.url
 
+    def check(self, lasthit, posts_count):
+        if (lasthit, posts_count) != (self.lasthit, self.posts_count):
+            self.lasthit = lasthit
+            self.posts_count = posts_count
+            self.changed = True
+        return self.changed
+
     def download(self, requests_session = None):
         if requests_session:
             req = requests_session
         else:
-            req = requests.Session()
+            req = Client()
 
-        self.data = req.get(BASEURL_BOARD + self.url)
-        if self.data.status_code != requests.codes.ok:
+        data = None
+        if self.incremental and self.last_num:
+            # Not conditional: the URL changes with every new post
+            data = req.get(URL_POSTS_AFTER.format(board=self.board, thread=self.num, num=self.last_num + 1))
+            self.data_prefix = posts.POSTS_AFTER
+            if data.status_code == requests.codes.not_found or \
+               (data.status_code == requests.codes.ok and 'json' not in data.headers.get('Content-Type', '')):
+                self.logger.info('Posts after N are not available, falling back to full thread updates')
+                self.incremental = False
+                data = None
+            elif data.status_code != requests.codes.ok:
+                self.logger.info('Posts after N failed with {}, downloading full thread'.format(data.status_code))
+                data = None
+        if data is None:
+            data = req.get(URL_THREAD.format(board=self.board, url=self.url), conditional=True)
+            self.data_prefix = posts.THREAD_POSTS
+        if data.status_code == requests.codes.not_modified:
+            self.logger.debug('Thread is not modified')
+            self.modified = False
+            return True
+        if data.status_code in (requests.codes.not_found, requests.codes.gone):
             self.logger.info('Thread is unavailable')
             return False
+        # Other errors are temporary, the thread stays changed and is retried
+        data.raise_for_status()
+        self.data = data
+        self.modified = True
         return True
 
     def parsevideos(self):
-        self.videos.clear()
+        if not self.modified:
+            return True
 
         try:
-            parser = json.loads(self.data.text)
-        except:
-            self.logger.error('Cannot parse thread JSON')
-            return
-
-        for post in parser['threads'][0]['posts']:
-            for postfile in post['files']:
-                if '.webm' in postfile['path']:
-                    webm = BASEURL + postfile['path']
-                    self.videos.append(webm)
+            for post in posts.iter_posts(self.data.content, self.data_prefix):
+                num = int(post.num)
+                if num <= self.last_num:
+                    continue
+                self.last_num = num
+                for postfile in post.files:
+                    if postfile.path and '.webm' in postfile.path:
+                        webm = BASEURL + postfile.path
+                        self.videos.append(Video(
+                            webm, postfile.md5, postfile.size, postfile.name,
+                            postfile.duration_secs or parse_duration(postfile.duration),
+                            postfile.width, postfile.height, self.board, self.num))
+        except posts.ParseError as e:
+            self.logger.error('Cannot parse thread JSON: {}'.format(e))
+            if self.data_prefix == posts.POSTS_AFTER:
+                self.incremental = False
+            return False
 
-        self.logger.info("New videos: {}".format(len(self.videos) - self.latest_video_index))
-        self.old_latest_video_index = self.latest_video_index
-        self.latest_video_index = len(self.videos)
+        self.logger.info("New videos: {}".format(len(self.videos) - self.videos_cursor))
+        return True
 
     def get_new_videos_list(self):
-        ret = list()
-        self.logger.debug('old_latest {}'.format(self.old_latest_video_index))
-        for i, video in enumerate(self.videos):
-            if i > self.old_latest_video_index:
-                ret.append(video)
-        self.old_latest_video_index = self.latest_video_index
+        ret = self.videos[self.videos_cursor:]
+        self.logger.debug('videos_cursor {}'.format(self.videos_cursor))
+        self.videos_cursor += len(ret)
         return ret
                 
 
 class Board(object):
-    def __init__(self):
-        self.logger = logging.getLogger('board')
-        self.req = requests.Session()
-        self.threads = list()
+    def __init__(self, board=BOARD, incremental=True, workers=8, save_dir=None, matcher=None, state=None,
+                 client=None, interval=30):
+        self.logger = logging.getLogger('board.' + board)
+        self.board = board
+        # Minimum number of seconds between updates, see Coordinator
+        self.interval = interval
+        self.state = state
+        self.matcher = matcher or Matcher(DEFAULT_INCLUDE)
+        # Filter result of every thread seen in the catalog
+        self.classified = dict()
+        self.incremental = incremental
+        self.workers = workers
+        # MD5 of every video already queued and of the saved ones,
+        # shared by all boards of a Coordinator
+        self.seen_md5 = set()
+        self.seen_lock = threading.Lock()
+        self.saved_files = SavedFiles(save_dir) if save_dir else None
+        self.req = client or Client(workers)
+        # Tracked threads by thread number, in discovery order
+        self.threads = collections.OrderedDict()
+        # Threads loaded from the state, checked against the matcher on the first catalog pass
+        self.unverified = set()
         self.data = None
+        self.modified = True
+        if self.state:
+            self.load_state()
+
+    def load_state(self):
+        for num, url, last_num, lasthit, posts_count, incremental, changed in self.state.load_threads(self.board):
+            thread = Thread(url, bool(incremental), self.board)
+            thread.last_num = last_num
+            thread.lasthit = lasthit
+            thread.posts_count = posts_count
+            # Still set if the last download failed
+            thread.changed = bool(changed)
+            self.threads[num] = thread
+            self.unverified.add(num)
+        self.seen_md5.update(self.state.load_files())
+        self.logger.info('Loaded {} threads and {} files from the state'.format(
+            len(self.threads), len(self.seen_md5)))
 
     def update(self):
-        self.data = self.req.get(URL)
+        data = self.req.get(URL_CATALOG.format(board=self.board), conditional=True)
+        self.modified = data.status_code != requests.codes.not_modified
+        if self.modified:
+            self.data = data
+        else:
+            self.logger.debug('Board is not modified')
 
-    def find_threads(self, include=r'([Ww][Ee][Bb][Mm])|([Цц][Уу][Ии][Ьь])|([ВвШш][Ее][Бб][Мм])',
-                     exclude=None):
+    def find_threads(self):
+        if not self.modified:
+            return
+
+        catalog = set()
+        excluded = list()
         try:
-            parser = json.loads(self.data.text)
-        except:
-            self.logger.error('Cannot parse board JSON')
+            for post in posts.iter_posts(self.data.content, posts.CATALOG_THREADS):
+                num = str(post.num)
+                catalog.add(num)
+                if num in self.unverified:
+                    # The keywords may have changed since the thread was saved
+                    self.unverified.discard(num)
+                    self.classified[num] = self.classify(post)
+                    if not self.classified[num]:
+                        self.logger.info('Thread {} does not match the keywords anymore'.format(num))
+                        self.req.forget(URL_THREAD.format(board=self.board, url=self.threads.pop(num).url))
+                        excluded.append(num)
+                        continue
+                if num in self.threads:
+                    if self.threads[num].check(post.lasthit, post.posts_count):
+                        self.logger.debug('Thread {} has changed'.format(num))
+                    continue
+                if num in self.classified:
+                    continue
+                url = '/res/{}.json'.format(num)
+                self.classified[num] = self.classify(post)
+                if self.classified[num]:
+                    self.logger.info('Found new Webm thread: {}'.format(URL_THREAD.format(board=self.board, url=url)))
+                    thread = Thread(url, self.incremental, self.board)
+                    thread.check(post.lasthit, post.posts_count)
+                    self.threads[num] = thread
+        except posts.ParseError as e:
+            self.logger.error('Cannot parse board JSON: {}'.format(e))
             return
 
-        for thread in parser['threads']:
-                url = '/res/' + thread['posts'][0]['num'] + '.json'
-                body = thread['posts'][0]['comment']
-                is_webm = any(['webm' in file['path'] for file in thread['posts'][0]['files']])
-                if is_webm and re.search(include, body) and not (re.search(exclude, body) if exclude else False):
-                    if Thread(url) not in self.threads:
-                        self.logger.info('Found new Webm thread: {}'.format(BASEURL_BOARD + url))
-                        self.threads.append(Thread(url))
+        gone = [num for num in self.threads if num not in catalog]
+        for num in gone:
+            self.logger.info('Thread {} is gone from the catalog'.format(num))
+            self.req.forget(URL_THREAD.format(board=self.board, url=self.threads.pop(num).url))
+        self.unverified.clear()
+        if self.state and (gone or excluded):
+            self.state.remove_threads(self.board, gone + excluded)
+        for num in [num for num in self.classified if num not in catalog]:
+            del self.classified[num]
         if not self.threads:
             self.logger.info('No threads found!')
 
-    def parse_threads(self):
-        for thread in self.threads:
+    def classify(self, post):
+        is_webm = any('webm' in (file.path or '') for file in post.files)
+        return is_webm and self.matcher.match(post.comment or '')
+
+    def update_thread(self, thread):
+        try:
             if not thread.download(self.req):
+                return False
+        except requests.RequestException as e:
+            self.logger.error('Cannot download thread {}: {}'.format(thread, e))
+            return True
+        self.logger.debug('parsing thread')
+        if not thread.parsevideos() and thread.data_prefix == posts.POSTS_AFTER:
+            # Incremental updates are off now, get the full thread
+            return self.update_thread(thread)
+        thread.changed = False
+        return True
+
+    def parse_threads(self):
+        # Only threads changed according to the catalog are downloaded and
+        # parsed, concurrently, results are collected in the original order
+        threads = [thread for thread in self.threads.values() if thread.changed]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            alive = list(executor.map(self.update_thread, threads))
+        for thread, is_alive in zip(threads, alive):
+            if not is_alive:
                 self.logger.debug('removing thread')
-                self.threads.remove(thread)
-            else:
-                self.logger.debug('parsing thread')
-                thread.parsevideos()
+                self.threads.pop(thread.num, None)
+        if self.state:
+            self.state.save_threads(self.board, [thread for thread, is_alive in zip(threads, alive) if is_alive])
+            self.state.remove_threads(self.board, [thread.num for thread, is_alive in zip(threads, alive) if not is_alive])
     
     def get_new_videos_list(self):
         ret = list()
-        for thread in self.threads:
+        seen = list()
+        for thread in self.threads.values():
             for video in thread.get_new_videos_list():
+                if video.md5:
+                    with self.seen_lock:
+                        duplicate = video.md5 in self.seen_md5
+                        self.seen_md5.add(video.md5)
+                    if duplicate:
+                        self.logger.debug('Skipping duplicate {}'.format(video.url))
+                        continue
+                    seen.append(video)
+                    if self.saved_files:
+                        path = self.saved_files.get(video.md5, video.size)
+                        if path:
+                            self.logger.debug('Using saved copy {} of {}'.format(path, video.url))
+                            video.path = path
+                        else:
+                            self.saved_files.add(video.md5, os.path.basename(video.url))
                 ret.append(video)
+        if self.state and seen:
+            self.state.add_files(seen)
         return ret
@@ -0,0 +1,42 @@
+# coding: utf-8
+import threading
+import logging
+
+
+class Worker(threading.Thread):
+    """
+    Background thread which keeps the player's video queue topped up.
+
+    update is a callable returning new videos. It is called whenever
+    the queue holds less than low_water videos, at most every interval
+    seconds unless woken up with wake().
+    """
+    def __init__(self, update, videoqueue, low_water=5, interval=30):
+        super().__init__(name='updater', daemon=True)
+        self.logger = logging.getLogger('worker')
+        self.update = update
+        self.videoqueue = videoqueue
+        self.low_water = low_water
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def fill_queue(self):
+        self.logger.info('Queue is low ({}), updating'.format(self.videoqueue.qsize()))
+        try:
+            videos = self.update()
+        except Exception:
+            self.logger.exception('Update failed')
+            return
+        for video in videos:
+            self.logger.debug('Got video {}'.format(video))
+            self.videoqueue.put(video)
+
+    def run(self):
+        while True:
+            if self.videoqueue.qsize() < self.low_water:
+                self.fill_queue()
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()